@@ -1,28 +1,55 @@
+import hashlib
+import json
+import time
+from dataclasses import dataclass
+
 import aqt
-from anki.collection import SearchNode
+from anki import hooks
+from anki.collection import Collection, OpChanges, SearchNode
+from anki.models import NotetypeId
+from anki.template import TemplateRenderContext
 from aqt import gui_hooks
-from aqt.qt import QAction, QMenu  # type: ignore
-from aqt.utils import qconnect, showInfo, tooltip
-from itertools import islice
+from aqt.operations import CollectionOp, QueryOp, on_op_finished
+from aqt.qt import QAction, QInputDialog, QMenu, QTimer  # type: ignore
+from aqt.utils import askUser, qconnect, showInfo, showWarning, tooltip
+from itertools import chain, islice
 
 from .common import (
     CONFIG_VERSION,
     Config,
+    Journal,
+    LazyData,
+    NoteStore,
     SupportsPendingChanges,
     VERSION,
+    batched,
     get_lazy_data,
     load_config,
+    load_state,
     log,
     mw,
+    save_state,
     show_report,
     show_update_nag,
 )
 from .hanziweb import PendingChanges as PendingHanziWebChanges
-from .hanziweb import get_hanzi_models
+from .hanziweb import (
+    HanziModel,
+    HanziWebIndex,
+    NOTE_WRITE_BATCH_SIZE,
+    StickyTerms,
+    WEB_FIELD_FILTER,
+    create_hanzi_web_index,
+    get_hanzi_models,
+    get_more_terms,
+    get_session_index,
+    render_on_display,
+    set_session_index,
+)
 from .jitai import PendingChanges as PendingJitaiChanges
 from anki.notes import NoteId
 from anki.decks import DeckId
-from typing import Sequence, Tuple, Any
+from typing import Any, Iterator, Optional, Sequence, Tuple
 from pprint import pprint
 from anki.consts import NEW_CARDS_DUE
 
@@ -45,12 +72,48 @@ ABOUT_TEXT = (
 )
 
 
-def update(config: Config, is_interactive: bool) -> None:
-    log("Reading lazy data")
-    lazy_data = get_lazy_data()
+FINGERPRINT_STATE = "fingerprint"
+
+
+def get_fingerprint(config: Config, js: str) -> list[Any]:
+    """Cheaply summarize everything a Hanzi Web run depends on.
+
+    If this is unchanged since the last run, running again would produce no changes.
+    Modification times are summed rather than only taking the latest, since syncs
+    bring in changes with the older times they were made at on other devices.
+    """
+    return [
+        VERSION,
+        config.digest,
+        hashlib.blake2b(js.encode("utf-8"), digest_size=16).hexdigest(),
+        mw.col.sched.today,
+        *mw.col.db.first(
+            "select "
+            "(select total(mod) from notes), "
+            "(select count() from notes), "
+            "(select total(mod) from cards), "
+            "(select count() from cards), "
+            "(select total(id) from revlog), "
+            "(select count() from revlog), "
+            "(select total(mtime_secs) from notetypes), "
+            "(select total(mtime_secs) from decks), "
+            "(select total(mtime_secs) from deck_config)"
+        ),
+    ]
+
+
+@dataclass(frozen=True)
+class NoteSearch:
+    base_search_string: str
+    japanese_search_string: str
+    source_note_ids: set[NoteId]
+    destination_note_ids: set[NoteId]
+    japanese_note_ids: set[NoteId]
 
-    hanzi_models = get_hanzi_models(config, lazy_data.js)
 
+def search_notes(
+    config: Config, hanzi_models: dict[NotetypeId, HanziModel]
+) -> NoteSearch:
     base_search_string = mw.col.build_search_string(
         config.search_query,
         mw.col.group_searches(
@@ -85,37 +148,122 @@ def update(config: Config, is_interactive: bool) -> None:
         else set()
     )
 
+    return NoteSearch(
+        base_search_string,
+        japanese_search_string,
+        source_note_ids,
+        destination_note_ids,
+        japanese_note_ids,
+    )
+
+
+@dataclass(frozen=True)
+class PreparedUpdate:
+    config: Config
+    lazy_data: LazyData
+    search: NoteSearch
+    hanzi_models: dict[NotetypeId, HanziModel]
+    store: NoteStore
+    journal: Journal
+    hanzi_web_changes: PendingHanziWebChanges
+    pending_changes: list[SupportsPendingChanges]
+
+
+def prepare_update(config: Config, is_interactive: bool) -> Optional[PreparedUpdate]:
+    """Find the changes of a run, or return None if nothing changed since the last run.
+
+    Nothing is written to the collection, so this may be run in the background.
+    """
+    log("Reading lazy data")
+    lazy_data = get_lazy_data()
+
+    # Interactive runs always do the full work so that the report can be reviewed.
+    if not is_interactive and get_fingerprint(config, lazy_data.js) == load_state(
+        FINGERPRINT_STATE
+    ):
+        log("Nothing changed since last run")
+        return None
+
+    hanzi_models = get_hanzi_models(config, lazy_data.js)
+    search = search_notes(config, hanzi_models)
+
+    # Both pipelines read and write the destination notes, so share them.
+    journal = Journal()
+    store = NoteStore(journal)
+
+    hanzi_web_changes = PendingHanziWebChanges(
+        config,
+        store,
+        search.source_note_ids,
+        search.destination_note_ids,
+        search.japanese_note_ids,
+        hanzi_models,
+        lazy_data.phonetics,
+        lazy_data.onyomi,
+        # Without a report to show, notes can be written as soon as they are rendered.
+        is_streaming=not is_interactive,
+        # Tables rendered on display only need writing for other devices, which is
+        # left to runs from the menu so that reviews don't rewrite them all day.
+        write_web_field=is_interactive or not config.render_on_display,
+    )
     pending_changes: list[SupportsPendingChanges] = [
-        PendingHanziWebChanges(
-            config,
-            source_note_ids,
-            destination_note_ids,
-            japanese_note_ids,
-            hanzi_models,
-            lazy_data.phonetics,
-            lazy_data.onyomi,
-        ),
+        hanzi_web_changes,
         PendingJitaiChanges(
             config,
-            destination_note_ids,
-            japanese_note_ids,
+            store,
+            search.destination_note_ids,
+            search.japanese_note_ids,
         ),
     ]
+    return PreparedUpdate(
+        config,
+        lazy_data,
+        search,
+        hanzi_models,
+        store,
+        journal,
+        hanzi_web_changes,
+        pending_changes,
+    )
+
+
+def update(config: Config, is_interactive: bool) -> bool:
+    """Run Hanzi Web, and return whether its changes are still being applied in the
+    background, in which case `end_update' is called once they are.
+    """
+    prepared = prepare_update(config, is_interactive)
+    if prepared is None:
+        return False
+    # Interactive runs apply in the background, but the sync must not start before
+    # the notes of automatic runs are written.
+    return apply_update(prepared, is_interactive, is_in_background=is_interactive)
+
+
+def apply_update(
+    prepared: PreparedUpdate, is_interactive: bool, is_in_background: bool
+) -> bool:
+    """Confirm and apply the changes of a run, and return whether they are still being
+    applied in the background, in which case `end_update' is called once they are.
+    """
+    config = prepared.config
+    hanzi_web_changes = prepared.hanzi_web_changes
+    pending_changes = prepared.pending_changes
 
     for change in pending_changes:
         if not change.confirm():
-            return
+            return False
 
     if is_interactive:
+        search = prepared.search
         report = [
             "Hanzi Web will update the following notes. Please ensure this ",
             "looks correct before continuing.\n\n",
-            f"Search query:\n  {base_search_string}\n",
-            f"Japanese search query:\n  {japanese_search_string}\n",
+            f"Search query:\n  {search.base_search_string}\n",
+            f"Japanese search query:\n  {search.japanese_search_string}\n",
             "Note types:\n",
         ]
 
-        for model in hanzi_models.values():
+        for model in prepared.hanzi_models.values():
             fields = ", ".join(model.fields)
             report.append(f"  {model.name} [{fields}]\n")
         report.append("\n")
@@ -124,23 +272,209 @@ def update(config: Config, is_interactive: bool) -> None:
             report.append(change.report)
             report.append("\n")
 
-        if not show_report("".join(report)):
-            return
+        # The per-note listing can be enormous, so it is generated lazily as the
+        # user pages through it.
+        details = chain.from_iterable(x.report_details() for x in pending_changes)
+        num_details = sum(x.num_report_details for x in pending_changes)
+        if not show_report("".join(report), details, num_details):
+            return False
+
+    def finish(tooltip_text: Sequence[str]) -> None:
+        if tooltip_text:
+            tooltip(" ".join(tooltip_text), parent=mw)
+        hanzi_web_changes.web_digests.save()
+        if hanzi_web_changes.sticky_terms:
+            hanzi_web_changes.sticky_terms.save()
+        set_session_index(
+            hanzi_web_changes.index if config.needs_session_index else None
+        )
+        save_state(FINGERPRINT_STATE, get_fingerprint(config, prepared.lazy_data.js))
 
-    # The checkpoint system (mw.checkpoint() and mw.reset()) are "obsoleted" in favor of
-    # Collection Operations. However, Collection Operations have a very short-term
-    # memory (~30), which is unsuitable for the potentially massive amounts of changes
-    # that Hanzi Web will do on a collection.
-    #
-    # https://addon-docs.ankiweb.net/background-ops.html?highlight=undo#collection-operations
-    if any(not x.is_empty for x in pending_changes):
-        # mw.checkpoint("Hanzi Web")
-        tooltip_text = [x.apply() for x in pending_changes]
-        mw.reset()
-        tooltip(" ".join(x for x in tooltip_text if x), parent=mw)
-    else:
+    if all(x.is_empty for x in pending_changes):
         if is_interactive:
             tooltip("No changes.", parent=mw)
+        finish([])
+        return False
+
+    if not is_in_background:
+        changes, tooltip_text = apply_pending_changes(
+            pending_changes, prepared.store, prepared.journal
+        )
+        on_op_finished(mw, changes, None)
+        finish(tooltip_text)
+        return False
+
+    applied_tooltip_text: list[str] = []
+    batches = iter_pending_changes_batches(prepared, applied_tooltip_text)
+    undo_entry: Optional[int] = None
+    is_done = False
+
+    def op(col: Collection) -> OpChanges:
+        nonlocal undo_entry, is_done
+        # The batches are merged into a single step to undo, unless something else
+        # was done in between.
+        if undo_entry is None or col.undo_status().last_step != undo_entry:
+            undo_entry = col.add_custom_undo_entry("Hanzi Web")
+        is_done = next(batches, True) is True
+        return col.merge_undo_entries(undo_entry)
+
+    def on_success(_: OpChanges) -> None:
+        if not is_done:
+            # Hand the collection back between batches.
+            mw.progress.single_shot(0, run_op)
+            return
+        try:
+            finish(applied_tooltip_text)
+        finally:
+            end_update()
+
+    def on_failure(e: Exception) -> None:
+        batches.close()
+        end_update()
+        showWarning(f"Hanzi Web failed to apply its changes: {e}")
+
+    def run_op() -> None:
+        CollectionOp(parent=mw, op=op).success(on_success).failure(
+            on_failure
+        ).run_in_background()
+
+    run_op()
+    return True
+
+
+def iter_pending_changes_batches(
+    prepared: PreparedUpdate, tooltip_text: list[str]
+) -> Iterator[None]:
+    """Apply the changes of a run, yielding after each batch of notes is written, and
+    add the text of the tooltip to `tooltip_text' once done.
+
+    Each batch is written by its own operation, so that Anki stays responsive while
+    a large run is applied.
+    """
+    store = prepared.store
+    hanzi_web_changes = prepared.hanzi_web_changes
+    prepared.journal.begin_run()
+    try:
+        # The other pipelines only stage their changes, which Hanzi Web then writes
+        # along with its own.
+        other_tooltip_text = [
+            x.apply()
+            for x in reversed(prepared.pending_changes)
+            if x is not hanzi_web_changes
+        ][::-1]
+        yield from hanzi_web_changes.apply_in_batches()
+        for batch in batched(store.staged_ids, NOTE_WRITE_BATCH_SIZE):
+            store.commit(batch)
+            yield
+    finally:
+        prepared.journal.end_run()
+    tooltip_text.extend(
+        x for x in [hanzi_web_changes.tooltip, *other_tooltip_text] if x
+    )
+
+
+def apply_pending_changes(
+    pending_changes: Sequence[SupportsPendingChanges],
+    store: NoteStore,
+    journal: Journal,
+) -> Tuple[OpChanges, list[str]]:
+    """Apply the changes as a single step which can be undone, and return what changed
+    along with the text of the tooltip.
+
+    Anki only keeps a few steps to undo, so every write of the run is merged into one.
+    Only the views of what changed are refreshed afterwards, rather than resetting
+    the main window.
+    """
+    undo_entry = mw.col.add_custom_undo_entry("Hanzi Web")
+    journal.begin_run()
+    try:
+        # Hanzi Web may write its notes while applying, so it is applied last to let
+        # those writes carry the changes staged by the other pipelines.
+        tooltip_text = [x.apply() for x in reversed(pending_changes)][::-1]
+        store.commit()
+    finally:
+        journal.end_run()
+    return mw.col.merge_undo_entries(undo_entry), [x for x in tooltip_text if x]
+
+
+def roll_back(fields: dict[NoteId, dict[str, str]]) -> OpChanges:
+    """Restore the given field values of the notes which still exist."""
+    undo_entry = mw.col.add_custom_undo_entry("Hanzi Web Rollback")
+    store = NoteStore()
+    for batch in batched(fields, NOTE_WRITE_BATCH_SIZE):
+        for id in batch:
+            for field, value in fields[id].items():
+                store.stage(id, field, value, preserve_text=True)
+        store.commit(batch)
+    return mw.col.merge_undo_entries(undo_entry)
+
+
+def roll_back_from_gui() -> None:
+    global _is_updating
+    if _is_updating:
+        showInfo("Hanzi Web is running. Please try again once it is done.")
+        return
+    # No run may write to the journal until the rollback is done, including while
+    # the dialogs are open.
+    _is_updating = True
+    is_in_background = False
+    try:
+        is_in_background = roll_back_with_dialogs()
+    finally:
+        if not is_in_background:
+            end_update()
+
+
+def roll_back_with_dialogs() -> bool:
+    """Ask which runs to roll back and do so, and return whether the rollback is still
+    in progress in the background, in which case `end_update' is called once it is.
+    """
+    journal = Journal()
+    if not journal.runs:
+        showInfo("There are no Hanzi Web runs to roll back.")
+        return False
+    last_run = time.strftime("%Y-%m-%d %H:%M", time.localtime(journal.runs[-1][0]))
+    num_runs, ok = QInputDialog.getInt(
+        mw,
+        "Hanzi Web",
+        f"Roll back how many of the last {len(journal.runs)} runs?\n"
+        f"The last run was on {last_run}.",
+        1,
+        1,
+        len(journal.runs),
+    )
+    if not ok:
+        return False
+    fields = journal.read(num_runs)
+    if not askUser(
+        f"Restore {len(fields)} notes to how they were before the last {num_runs} "
+        "Hanzi Web run(s)?\n\n"
+        "Automatic runs will be paused for the rest of the session, as they would "
+        "write the same fields again. Running Hanzi Web from the menu resumes them."
+    ):
+        return False
+
+    def on_success(changes: OpChanges) -> None:
+        global _is_paused
+        try:
+            # Truncate the journal as it is on disk now, not the copy read before
+            # the dialogs.
+            Journal().truncate(num_runs)
+            _is_paused = True
+            # Whatever the index was built from may have been rolled back.
+            set_session_index(None)
+            tooltip(f"Hanzi Web: {len(fields)} note(s) rolled back.", parent=mw)
+        finally:
+            end_update()
+
+    def on_failure(e: Exception) -> None:
+        end_update()
+        showWarning(f"Hanzi Web failed to roll back: {e}")
+
+    CollectionOp(parent=mw, op=lambda _: roll_back(fields)).success(on_success).failure(
+        on_failure
+    ).run_in_background()
+    return True
 
 
 def get_next_n_days_of_note_ids(
@@ -190,18 +524,193 @@ def get_next_n_days_of_note_ids(
     return next_n_days_note_ids
 
 
-def maybe_update_from_gui() -> None:
+def build_session_index(config: Config) -> HanziWebIndex:
+    lazy_data = get_lazy_data()
+    hanzi_models = get_hanzi_models(config, lazy_data.js)
+    search = search_notes(config, hanzi_models)
+    return create_hanzi_web_index(
+        config,
+        search.source_note_ids.union(search.destination_note_ids),
+        search.destination_note_ids,
+        hanzi_models,
+        search.japanese_note_ids,
+        lazy_data.phonetics,
+        lazy_data.onyomi,
+        # List the same notes as the fields, without saving anything.
+        StickyTerms(config.sticky_terms_tolerance) if config.sticky_terms else None,
+    )
+
+
+_is_building_session_index = False
+
+
+def build_session_index_in_background(config: Config) -> None:
+    global _is_building_session_index
+    if _is_building_session_index:
+        return
+    _is_building_session_index = True
+
+    def on_done(index: Optional[HanziWebIndex]) -> None:
+        global _is_building_session_index
+        _is_building_session_index = False
+        # Don't replace the index of a run which finished in the meantime.
+        if index and not get_session_index():
+            set_session_index(index)
+
+    def on_failure(e: Exception) -> None:
+        on_done(None)
+        log(f"Building the session index failed: {e}")
+
+    QueryOp(
+        parent=mw,
+        op=lambda _: build_session_index(config),
+        success=on_done,
+    ).failure(on_failure).run_in_background()
+
+
+def on_profile_did_open() -> None:
     config = load_config()
     if config.config_version < CONFIG_VERSION:
-        show_update_nag()
-    else:
-        update(config, is_interactive=True)
+        return
+    if config.needs_session_index:
+        build_session_index_in_background(config)
+    start_idle_timer(config)
+
+
+def on_profile_will_close() -> None:
+    global _is_paused
+    stop_idle_timer()
+    _is_paused = False
+    set_session_index(None)
+
+
+def on_field_filter(
+    field_text: str, field_name: str, filter_name: str, ctx: TemplateRenderContext
+) -> str:
+    if filter_name != WEB_FIELD_FILTER:
+        return field_text
+    return render_on_display(field_text, field_name, ctx.note().id)
+
+
+# Whether a run is in progress, including one applying its changes in the background.
+_is_updating = False
+# Whether automatic runs are paused, after a rollback, until a run from the menu.
+_is_paused = False
+# Whether another run was requested during the current one, and if so, whether any of
+# those requests came from the GUI. They are all coalesced into a single run.
+_pending_update: Optional[bool] = None
+
+
+def request_update(is_interactive: bool) -> None:
+    """Run Hanzi Web, unless it is already running, in which case run it once more
+    afterwards.
+    """
+    global _is_updating, _is_paused, _pending_update
+    if not is_interactive and _is_paused:
+        log("Paused since a rollback")
+        return
+    if _is_updating:
+        _pending_update = bool(_pending_update) or is_interactive
+        log("Already running; running again afterwards")
+        return
+    _is_updating = True
+    _is_paused = False
+    is_in_background = False
+    try:
+        config = load_config()
+        if is_interactive and config.config_version < CONFIG_VERSION:
+            show_update_nag()
+        elif is_interactive or (
+            config.config_version >= CONFIG_VERSION and config.auto_run_on_sync
+        ):
+            is_in_background = update(config, is_interactive)
+    finally:
+        if not is_in_background:
+            end_update()
+
+
+def end_update() -> None:
+    global _is_updating, _pending_update
+    _is_updating = False
+    if _pending_update is not None:
+        is_interactive = _pending_update
+        _pending_update = None
+        # Let whatever finished the previous run return first.
+        mw.progress.single_shot(0, lambda: request_update(is_interactive))
+
+
+def update_in_background(config: Config) -> None:
+    """Run Hanzi Web without a report, entirely in the background."""
+    global _is_updating
+    _is_updating = True
+
+    def on_prepared(prepared: Optional[PreparedUpdate]) -> None:
+        is_in_background = False
+        try:
+            if prepared:
+                is_in_background = apply_update(
+                    prepared, is_interactive=False, is_in_background=True
+                )
+        finally:
+            if not is_in_background:
+                end_update()
 
+    def on_failure(e: Exception) -> None:
+        end_update()
+        log(f"Updating in the background failed: {e}")
 
-def maybe_update_from_hook() -> None:
+    QueryOp(
+        parent=mw,
+        op=lambda _: prepare_update(config, is_interactive=False),
+        success=on_prepared,
+    ).failure(on_failure).run_in_background()
+
+
+# Fires every `auto_run_when_idle' seconds without any activity in the reviewer.
+_idle_timer: Optional[QTimer] = None
+
+
+def start_idle_timer(config: Config) -> None:
+    global _idle_timer
+    stop_idle_timer()
+    if config.auto_run_when_idle <= 0:
+        return
+    _idle_timer = QTimer(mw)
+    _idle_timer.setInterval(config.auto_run_when_idle * 1000)
+    qconnect(_idle_timer.timeout, on_idle)
+    _idle_timer.start()
+
+
+def stop_idle_timer() -> None:
+    global _idle_timer
+    if _idle_timer:
+        _idle_timer.stop()
+        _idle_timer.deleteLater()
+        _idle_timer = None
+
+
+def restart_idle_timer() -> None:
+    if _idle_timer:
+        _idle_timer.start()
+
+
+def on_idle() -> None:
+    # Cards being reviewed would be redrawn as their notes change.
+    if _is_updating or _is_paused or mw.state == "review" or not mw.col:
+        return
     config = load_config()
-    if config.config_version >= CONFIG_VERSION and config.auto_run_on_sync:
-        update(config, is_interactive=False)
+    # Runs are skipped by their fingerprint unless something changed, including the
+    # day rolling over, so checking again on every tick is cheap.
+    if config.config_version >= CONFIG_VERSION and config.auto_run_when_idle > 0:
+        update_in_background(config)
+
+
+def maybe_update_from_gui() -> None:
+    request_update(is_interactive=True)
+
+
+def maybe_update_from_hook() -> None:
+    request_update(is_interactive=False)
 
 
 def on_webview_did_receive_js_message(
@@ -224,23 +733,40 @@ def on_webview_did_receive_js_message(
     elif args[0] == "hanziwebBrowse":
         browser = aqt.dialogs.open("Browser", mw.window())
         browser.search_for_terms(args[1])
+    elif args[0] == "hanziwebMoreTerms":
+        ret = get_more_terms(*json.loads(args[1]))
+        if ret is None and not get_session_index():
+            # The JS falls back to the action of the row this time; have the index
+            # ready for the next click.
+            config = load_config()
+            if config.config_version >= CONFIG_VERSION:
+                build_session_index_in_background(config)
     return (True, ret)
 
 
 def init() -> None:
     menu = QMenu("Hanzi &Web", mw)
     update_action = QAction("&Update notes", menu)
+    roll_back_action = QAction("&Roll back runs...", menu)
     about_action = QAction("&About...", menu)
     update_action.setShortcut("Ctrl+W")
     menu.addAction(update_action)
+    menu.addAction(roll_back_action)
     menu.addAction(about_action)
     qconnect(update_action.triggered, maybe_update_from_gui)
+    qconnect(roll_back_action.triggered, roll_back_from_gui)
     qconnect(about_action.triggered, lambda: showInfo(ABOUT_TEXT))
     mw.form.menuTools.addMenu(menu)
 
     gui_hooks.sync_will_start.append(maybe_update_from_hook)
     gui_hooks.sync_did_finish.append(maybe_update_from_hook)
     gui_hooks.webview_did_receive_js_message.append(on_webview_did_receive_js_message)
+    gui_hooks.profile_did_open.append(on_profile_did_open)
+    gui_hooks.profile_will_close.append(on_profile_will_close)
+    gui_hooks.reviewer_did_show_question.append(lambda *_: restart_idle_timer())
+    gui_hooks.reviewer_did_answer_card.append(lambda *_: restart_idle_timer())
+    gui_hooks.state_did_change.append(lambda *_: restart_idle_timer())
+    hooks.field_filter.append(on_field_filter)
 
 
 init()
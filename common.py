@@ -1,22 +1,47 @@
+import gzip
+import hashlib
 import json
+import os
 import re
+import time
 import unicodedata
 import html
 import urllib
-from pathlib import PurePath
+from dataclasses import asdict, dataclass, fields as dataclass_fields
+from pathlib import Path, PurePath
 from enum import Enum
 from re import Pattern
-from typing import Any, Optional, Protocol, Tuple, Union, Sequence
+from typing import (
+    Any,
+    Callable,
+    Iterable,
+    Iterator,
+    Optional,
+    Protocol,
+    Tuple,
+    Union,
+    Sequence,
+)
 from io import StringIO
+from itertools import islice
 
-from anki.notes import NoteId
+from anki.models import NotetypeId
+from anki.notes import Note, NoteId
+from anki.utils import ids2str
 from anki.config import Config as AnkiConfig
 from aqt import mw as mw_optional
 from aqt.main import AnkiQt
 from aqt.qt import (  # type: ignore
+    QAbstractListModel,
     QDialog,
     QDialogButtonBox,
+    QHBoxLayout,
+    QLabel,
+    QListView,
+    QModelIndex,
     QPlainTextEdit,
+    QPushButton,
+    Qt,
     QVBoxLayout,
 )
 from aqt.utils import qconnect, showWarning, showInfo
@@ -31,10 +56,14 @@ mw: AnkiQt = assert_is_not_none(mw_optional)
 
 VERSION = "1.3.1"
 CONFIG_VERSION = 1
-JS_VERSION = 1
+JS_VERSION = 3
+
+# The CJK unified ideographs, their extensions (including those in the supplementary
+# planes), and the compatibility ideographs.
+_HANZI_RANGES = r"\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\U00020000-\U000323af"
 
-# Matches each hanzi character individually.
-HANZI_REGEXP = re.compile(r"[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]")
+# Matches runs of anything but hanzi and the unit separator.
+_NON_HANZI_REGEXP = re.compile(f"[^\\x1f{_HANZI_RANGES}]+")
 
 # Matches JS sigil in template.
 _JS_SIGIL = f"/* DO NOT EDIT! -- Hanzi Web JS v{JS_VERSION} */\n"
@@ -54,6 +83,7 @@ _FURIGANA_REGEXP = re.compile(r" ?([^ >]+?)\[(.+?)\]")
 
 class Config:
     auto_run_on_sync: bool
+    auto_run_when_idle: int
     click_hanzi_action: Any
     click_hanzi_term_action: Any
     click_phonetic_action: Any
@@ -64,11 +94,17 @@ class Config:
     japanese_search_query: str
     kyujitai_field: str
     max_terms_per_hanzi: int
+    more_terms_link: bool
+    render_on_display: bool
     search_query: str
+    sticky_terms: bool
+    sticky_terms_tolerance: int
     term_separator: str
     web_field: str
 
     js_required: bool
+    needs_session_index: bool
+    digest: str
 
     def __init__(self, config: dict[str, Any]):
         self.config_version = config.get("config_version") or 0
@@ -106,6 +142,8 @@ class Config:
             5 if max_terms_per_hanzi is None else max_terms_per_hanzi
         )
 
+        self.more_terms_link = config.get("more_terms_link") or False
+
         self.search_query = config.get("search_query") or ""
 
         self.term_separator = config.get("term_separator") or "、"
@@ -119,13 +157,32 @@ class Config:
         auto_run_on_sync = config.get("auto_run_on_sync")
         self.auto_run_on_sync = False if auto_run_on_sync is None else auto_run_on_sync
 
+        self.auto_run_when_idle = config.get("auto_run_when_idle") or 0
+
+        self.render_on_display = config.get("render_on_display") or False
+
+        self.sticky_terms = config.get("sticky_terms") or False
+
+        sticky_terms_tolerance = config.get("sticky_terms_tolerance")
+        self.sticky_terms_tolerance = (
+            1 if sticky_terms_tolerance is None else sticky_terms_tolerance
+        )
+
         # Derived properties.
+        self.digest = hashlib.blake2b(
+            json.dumps(config, sort_keys=True).encode("utf-8"), digest_size=16
+        ).hexdigest()
         self.js_required = (
             self.click_hanzi_action != ":none"
             or self.click_hanzi_term_action != ":none"
             or self.click_phonetic_action != ":none"
             or self.click_phonetic_term_action != ":none"
         )
+        # The index of the last run holds every note it read, so it is only kept
+        # for the rest of the session if something renders from it.
+        self.needs_session_index = self.render_on_display or (
+            self.more_terms_link and self.js_required and self.max_terms_per_hanzi > 0
+        )
 
     @classmethod
     def _validate_click_action(cls, object: Any) -> Any:
@@ -161,22 +218,49 @@ def load_config() -> Config:
     return Config(assert_is_not_none(mw.addonManager.getConfig(__name__)))
 
 
+class Phonetics:
+    """Phonetic series, as generated by tools/make-phonetics.py.
+
+    Japanese notes are indexed separately, because they are looked up by the kyūjitai
+    forms of their hanzi.
+    """
+
+    # Phonetic components of each hanzi.
+    components: dict[str, str]
+    japanese_components: dict[str, str]
+    # Hanzi in each phonetic series, by component.
+    series: dict[str, frozenset[str]]
+    japanese_series: dict[str, frozenset[str]]
+
+    def __init__(self, phonetics: dict[str, dict[str, str]]):
+        self.components = phonetics["components"]
+        self.japanese_components = phonetics["japanese_components"]
+        self.series = {
+            component: frozenset(members)
+            for component, members in phonetics["series"].items()
+        }
+        self.japanese_series = {
+            component: frozenset(members)
+            for component, members in phonetics["japanese_series"].items()
+        }
+
+
 class LazyData:
     onyomi: dict[str, list[Tuple[str, list[str]]]]
-    phonetics: dict[str, str]
+    phonetics: Phonetics
     js: str
 
     def __init__(
         self,
         onyomi: dict[str, list[list[str]]],
-        phonetics: dict[str, str],
+        phonetics: dict[str, dict[str, str]],
         js: str,
     ):
         self.onyomi = {
             kanji: [(readings[0], readings[1:]) for readings in all_readings]
             for kanji, all_readings in onyomi.items()
         }
-        self.phonetics = phonetics
+        self.phonetics = Phonetics(phonetics)
         self.js = js
 
 
@@ -207,19 +291,79 @@ def get_lazy_data() -> LazyData:
     return _lazy_data
 
 
-def normalize_unicode(string: str) -> str:
-    return (
-        unicodedata.normalize("NFC", string)
-        if mw.col.get_config_bool(AnkiConfig.Bool.NORMALIZE_NOTE_TEXT)
-        else string
-    )
+def _state_path(name: str) -> Path:
+    return Path(__file__).parent / "user_files" / mw.pm.name / f"{name}.json"
+
+
+def load_state(name: str) -> Optional[Any]:
+    """Load a value saved with `save_state' for the current profile, if any."""
+    try:
+        with open(_state_path(name), "r", encoding="utf-8") as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return None
+
+
+def save_state(name: str, value: Any) -> None:
+    path = _state_path(name)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = path.with_suffix(".tmp")
+    with open(temp_path, "w", encoding="utf-8") as fp:
+        json.dump(value, fp, ensure_ascii=False, separators=(",", ":"))
+    os.replace(temp_path, path)
+
+
+def extract_hanzi(texts: Iterable[str]) -> list[str]:
+    """Return the hanzi contained in each of `texts', in order.
+
+    All texts are classified in a single pass of the regexp engine. They must not
+    contain the unit separator, which is also what Anki separates fields with.
+    """
+    return _NON_HANZI_REGEXP.sub("", "\x1f".join(texts)).split("\x1f")
+
+
+def batched(iterable: Iterable[Any], n: int) -> Iterator[list[Any]]:
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, n)):
+        yield batch
+
+
+class ReportDetailsModel(QAbstractListModel):  # type: ignore
+    """List model which pulls its rows from an iterator one page at a time."""
+
+    def __init__(self, lines: Iterator[str], parent: Any):
+        super().__init__(parent)
+        self._lines = lines
+        self._rows: list[str] = []
+        self.is_exhausted = False
+
+    def rowCount(self, parent: Any = QModelIndex()) -> int:
+        return 0 if parent.isValid() else len(self._rows)
+
+    def data(self, index: Any, role: Any = Qt.ItemDataRole.DisplayRole) -> Any:
+        if index.isValid() and role == Qt.ItemDataRole.DisplayRole:
+            return self._rows[index.row()]
+        return None
+
+    def load_more(self, count: int) -> None:
+        page = list(islice(self._lines, count))
+        if len(page) < count:
+            self.is_exhausted = True
+        if not page:
+            return
+        first = len(self._rows)
+        self.beginInsertRows(QModelIndex(), first, first + len(page) - 1)
+        self._rows.extend(page)
+        self.endInsertRows()
 
 
 class ReportDialog(QDialog):  # type: ignore
-    def __init__(self, text: str):
+    PAGE_SIZE = 1000
+
+    def __init__(self, text: str, details: Iterable[str], num_details: int):
         super().__init__(mw)
         self.setWindowTitle("Hanzi Web")
-        self.resize(400, 400)
+        self.resize(400, 500)
 
         layout = QVBoxLayout(self)
         self.setLayout(layout)
@@ -230,6 +374,25 @@ class ReportDialog(QDialog):  # type: ignore
         textedit.setReadOnly(True)
         layout.addWidget(textedit)
 
+        # Construct details list, which is only populated as far as the user asks.
+        self.details_model = ReportDetailsModel(iter(details), self)
+        self.num_details = num_details
+        details_view = QListView(self)
+        details_view.setModel(self.details_model)
+        details_view.setUniformItemSizes(True)
+        layout.addWidget(details_view)
+
+        details_layout = QHBoxLayout()
+        self.details_label = QLabel(self)
+        details_layout.addWidget(self.details_label)
+        details_layout.addStretch()
+        self.show_more_button = QPushButton("Show more", self)
+        self.show_more_button.setAutoDefault(False)
+        details_layout.addWidget(self.show_more_button)
+        layout.addLayout(details_layout)
+        qconnect(self.show_more_button.clicked, self.show_more)
+        self.show_more()
+
         button_box = QDialogButtonBox(
             QDialogButtonBox.StandardButton.Apply
             | QDialogButtonBox.StandardButton.Cancel
@@ -246,9 +409,18 @@ class ReportDialog(QDialog):  # type: ignore
         qconnect(button_box.accepted, self.accept)
         qconnect(button_box.rejected, self.reject)
 
+    def show_more(self) -> None:
+        self.details_model.load_more(self.PAGE_SIZE)
+        self.details_label.setText(
+            f"Showing {self.details_model.rowCount()} of {self.num_details} lines"
+        )
+        self.show_more_button.setEnabled(not self.details_model.is_exhausted)
 
-def show_report(text: str) -> bool:
-    return bool(ReportDialog(text).exec() == QDialog.DialogCode.Accepted)
+
+def show_report(text: str, details: Iterable[str], num_details: int) -> bool:
+    return bool(
+        ReportDialog(text, details, num_details).exec() == QDialog.DialogCode.Accepted
+    )
 
 
 def show_update_nag() -> None:
@@ -268,11 +440,253 @@ def html_tag(
     return f"<{tag}>{content}</{tag}>"
 
 
-def strip_kana_and_html(text: str) -> str:
+def parse_kana_and_html(text: str) -> Tuple[str, list[Tuple[str, str]]]:
+    """Strip HTML and Anki-style furigana from `text'.
+
+    Returns the escaped base text and the (base, reading) pairs of the furigana.
+    """
     text = _TAG_REGEXP.sub("", text)
     text = text.replace("&nbsp;", " ")
-    text = _FURIGANA_REGEXP.sub(r"\1", text)
-    return html.escape(text)
+    pieces: list[str] = []
+    furigana: list[Tuple[str, str]] = []
+    end = 0
+    for m in _FURIGANA_REGEXP.finditer(text):
+        pieces.append(text[end : m.start()])
+        pieces.append(m[1])
+        furigana.append((m[1], m[2]))
+        end = m.end()
+    pieces.append(text[end:])
+    return html.escape("".join(pieces)), furigana
+
+
+@dataclass(frozen=True)
+class ParsedField:
+    # The field text, normalized the same way Anki does.
+    text: str
+    # The hanzi of `text', in order.
+    hanzi: str
+    # The field text without HTML and furigana; see `parse_kana_and_html'.
+    stripped: str
+    furigana: Sequence[Tuple[str, str]]
+
+
+class FieldCache:
+    """Parsed note fields, kept across runs and reparsed only when they change."""
+
+    is_normalizing: bool
+
+    def __init__(self, is_normalizing: bool):
+        self.is_normalizing = is_normalizing
+        self._entries: dict[Tuple[NoteId, str], Tuple[bytes, ParsedField]] = {}
+
+    def parse(self, fields: Sequence[Tuple[NoteId, str, str]]) -> list[ParsedField]:
+        """Parse each (note ID, field name, field value) of `fields'."""
+        result: list[Optional[ParsedField]] = []
+        misses: list[Tuple[int, Tuple[NoteId, str], bytes, str]] = []
+        for id, name, value in fields:
+            key = (id, name)
+            digest = hashlib.blake2b(value.encode("utf-8"), digest_size=16).digest()
+            entry = self._entries.get(key)
+            if entry and entry[0] == digest:
+                result.append(entry[1])
+            else:
+                misses.append((len(result), key, digest, value))
+                result.append(None)
+
+        if misses:
+            texts = [
+                unicodedata.normalize("NFC", value) if self.is_normalizing else value
+                for _, _, _, value in misses
+            ]
+            for (index, key, digest, value), text, hanzi in zip(
+                misses, texts, extract_hanzi(texts)
+            ):
+                stripped, furigana = parse_kana_and_html(value)
+                parsed = ParsedField(text, hanzi, stripped, furigana)
+                self._entries[key] = (digest, parsed)
+                result[index] = parsed
+
+        return result  # type: ignore
+
+
+_field_cache: Optional[FieldCache] = None
+
+
+def get_field_cache() -> FieldCache:
+    global _field_cache
+    is_normalizing = mw.col.get_config_bool(AnkiConfig.Bool.NORMALIZE_NOTE_TEXT)
+    if not _field_cache or _field_cache.is_normalizing != is_normalizing:
+        _field_cache = FieldCache(is_normalizing)
+    return _field_cache
+
+
+CONFIG_NORMALIZE_NOTE_TEXT = "normalize_note_text"
+
+
+JOURNAL_STATE = "journal"
+# Runs beyond this many are dropped from the journal.
+JOURNAL_MAX_RUNS = 10
+
+
+class Journal:
+    """Append-only record of the field values overwritten by each run, from which
+    runs are rolled back.
+
+    Records are appended to a gzip file in `user_files' as they are written. The
+    start time, offset and number of notes of each run are kept in the journal state,
+    so that runs are pruned and read back without decompressing those before them.
+    """
+
+    def __init__(self) -> None:
+        self.path = _state_path(JOURNAL_STATE).with_suffix(".jsonl.gz")
+        self.runs: list[list[int]] = load_state(JOURNAL_STATE) or []
+        if not self.path.exists():
+            self.runs = []
+
+    def begin_run(self) -> None:
+        if len(self.runs) >= JOURNAL_MAX_RUNS:
+            self._prune(len(self.runs) - JOURNAL_MAX_RUNS + 1)
+        offset = self.path.stat().st_size if self.path.exists() else 0
+        self.runs.append([int(time.time()), offset, 0])
+
+    def record(self, fields: Iterable[Tuple[NoteId, dict[str, str]]]) -> None:
+        """Record the previous values of the fields of notes about to be written."""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # Each call appends its own gzip member.
+        with gzip.open(self.path, "at", encoding="utf-8") as fp:
+            for id, values in fields:
+                fp.write(json.dumps([id, values], ensure_ascii=False))
+                fp.write("\n")
+                self.runs[-1][2] += 1
+
+    def end_run(self) -> None:
+        if self.runs and not self.runs[-1][2]:
+            self.runs.pop()
+        save_state(JOURNAL_STATE, self.runs)
+
+    def read(self, num_runs: int) -> dict[NoteId, dict[str, str]]:
+        """Return the field values from before the last `num_runs' runs."""
+        fields: dict[NoteId, dict[str, str]] = {}
+        with open(self.path, "rb") as raw_fp:
+            raw_fp.seek(self.runs[-num_runs][1])
+            fp = gzip.open(raw_fp, "rt", encoding="utf-8")
+            for line in fp:
+                id, values = json.loads(line)
+                # The earliest value of a field is the one from before these runs.
+                note_fields = fields.setdefault(NoteId(id), {})
+                for field, value in values.items():
+                    note_fields.setdefault(field, value)
+        return fields
+
+    def truncate(self, num_runs: int) -> None:
+        """Drop the last `num_runs' runs."""
+        os.truncate(self.path, self.runs[-num_runs][1])
+        del self.runs[-num_runs:]
+        save_state(JOURNAL_STATE, self.runs)
+
+    def _prune(self, num_runs: int) -> None:
+        """Drop the first `num_runs' runs."""
+        offset = self.runs[num_runs][1] if num_runs < len(self.runs) else None
+        temp_path = self.path.with_suffix(".tmp")
+        with open(temp_path, "wb") as out:
+            if offset is not None:
+                with open(self.path, "rb") as fp:
+                    fp.seek(offset)
+                    while chunk := fp.read(1 << 20):
+                        out.write(chunk)
+        os.replace(temp_path, self.path)
+        self.runs = [
+            [start, run_offset - (offset or 0), num_notes]
+            for start, run_offset, num_notes in self.runs[num_runs:]
+        ]
+
+
+class NoteStore:
+    """Changes to notes shared between the pipelines of a single Hanzi Web run.
+
+    All changes staged by the pipelines are written back with a single update per
+    note. Only the staged values are held on to, and notes are loaded again when
+    they are written, so that a run never holds every destination note, nor writes
+    back a copy which was edited in the meantime.
+    """
+
+    def __init__(self, journal: Optional[Journal] = None):
+        """If a `journal' is given, the previous values of all written fields are
+        recorded in it.
+        """
+        self._journal = journal
+        self._staged: dict[NoteId, dict[str, str]] = {}
+        self._preserve_text = False
+
+    def get(self, id: NoteId) -> Note:
+        """Load a note, without the changes staged for it."""
+        return mw.col.get_note(id)
+
+    def stage(
+        self, id: NoteId, field: str, value: str, preserve_text: bool = False
+    ) -> None:
+        """Stage a field change to be written by `commit'.
+
+        If `preserve_text' is set, Anki is prevented from normalizing the text of the
+        note when it is written.
+        """
+        self._staged.setdefault(id, {})[field] = value
+        self._preserve_text = self._preserve_text or preserve_text
+
+    @property
+    def staged_ids(self) -> list[NoteId]:
+        return list(self._staged)
+
+    def commit(self, ids: Optional[Iterable[NoteId]] = None) -> int:
+        """Write the staged changes, or only those of `ids', and return the number of
+        notes written.
+
+        Written changes are dropped from the store, so that streamed batches are not
+        all kept in memory. Notes deleted since their changes were staged are skipped.
+        """
+        if ids is None:
+            staged = self._staged
+            self._staged = {}
+        else:
+            staged = {
+                id: fields for id in ids if (fields := self._staged.pop(id, None))
+            }
+        notes: list[Note] = []
+        previous_values: list[Tuple[NoteId, dict[str, str]]] = []
+        for id in mw.col.db.list(f"select id from notes where id in {ids2str(staged)}"):
+            note = mw.col.get_note(id)
+            fields = {k: v for k, v in staged[id].items() if k in note}
+            if self._journal:
+                previous_values.append((note.id, {k: note[k] for k in fields}))
+            for field, value in fields.items():
+                note[field] = value
+            notes.append(note)
+        if self._journal and previous_values:
+            self._journal.record(previous_values)
+        if notes:
+            self._write(notes)
+        if not self._staged:
+            self._preserve_text = False
+        return len(notes)
+
+    def _write(self, notes: list[Note]) -> None:
+        if self._preserve_text:
+            # Prevent Anki from un-kyujitai-ing these character forms. The setting
+            # is changed undoably, as changes which can't be undone would clear the
+            # undo queue in the middle of a run.
+            normalize_note_text = mw.col.conf.get(CONFIG_NORMALIZE_NOTE_TEXT)
+            try:
+                mw.col.set_config(CONFIG_NORMALIZE_NOTE_TEXT, False, undoable=True)
+                mw.col.update_notes(notes)
+            finally:
+                if normalize_note_text is None:
+                    mw.col.remove_config(CONFIG_NORMALIZE_NOTE_TEXT)
+                else:
+                    mw.col.set_config(
+                        CONFIG_NORMALIZE_NOTE_TEXT, normalize_note_text, undoable=True
+                    )
+        else:
+            mw.col.update_notes(notes)
 
 
 def log(message: str) -> None:
@@ -291,6 +705,13 @@ class SupportsPendingChanges(Protocol):
     def report(self) -> str:
         pass
 
+    @property
+    def num_report_details(self) -> int:
+        pass
+
+    def report_details(self) -> Iterator[str]:
+        pass
+
     def apply(self) -> Optional[str]:
         pass
 
@@ -307,6 +728,7 @@ def inject_js_into_html(config: Config, js: str, html: str) -> tuple[str, int]:
     def inject() -> None:
         buffer.write(_JS_SIGIL)
         buffer.write("(function(){\n")
+        dump_object("hanziwebJsVersion", JS_VERSION)
         dump_object("hanziwebHanziActions", config.click_hanzi_action)
         dump_object("hanziwebHanziTermActions", config.click_hanzi_term_action)
         dump_object("hanziwebPhoneticActions", config.click_phonetic_action)
@@ -364,3 +786,106 @@ def inject_js_into_html(config: Config, js: str, html: str) -> tuple[str, int]:
         buffer.write("</script>")
 
     return buffer.getvalue(), previous_version
+
+
+def inject_into_templates(
+    model_dict: dict[str, Any], config: Config, js: str
+) -> tuple[bool, int]:
+    max_previous_js_version = -1
+    is_dirty = False
+    for template in model_dict["tmpls"]:
+        for side in ("qfmt", "afmt"):
+            html, this_previous_js_version = inject_js_into_html(
+                config, js, template[side]
+            )
+            max_previous_js_version = max(
+                max_previous_js_version, this_previous_js_version
+            )
+            if template[side] != html:
+                is_dirty = True
+                template[side] = html
+    return is_dirty, max_previous_js_version
+
+
+NOTETYPE_PLANS_STATE = "notetype-plans"
+
+
+@dataclass(frozen=True)
+class NotetypePlan:
+    """What Hanzi Web does with a note type, which holds for as long as neither the
+    note type, the config nor the JS change.
+    """
+
+    name: str
+    # Fields matching `hanzi_fields_regexp', in order, and their positions.
+    hanzi_fields: list[str]
+    hanzi_field_ords: list[int]
+    has_web_field: bool
+    # Position of the `kyujitai_field', if the note type has one.
+    kyujitai_field_ord: Optional[int]
+    # Whether injecting the JS changes the templates, and the newest version of the
+    # JS they already have.
+    is_dirty: bool
+    max_previous_js_version: int
+
+
+def create_notetype_plan(
+    config: Config, js: str, id: NotetypeId, name: str
+) -> NotetypePlan:
+    model_dict = assert_is_not_none(mw.col.models.get(id))
+    all_fields = mw.col.models.field_names(model_dict)
+    hanzi_field_ords = [
+        i
+        for i, x in enumerate(all_fields)
+        if assert_is_not_none(config.hanzi_fields_regexp).fullmatch(x)
+    ]
+    hanzi_fields = [all_fields[i] for i in hanzi_field_ords]
+    is_dirty, max_previous_js_version = (
+        inject_into_templates(model_dict, config, js) if hanzi_fields else (False, -1)
+    )
+    return NotetypePlan(
+        name,
+        hanzi_fields,
+        hanzi_field_ords,
+        config.web_field in all_fields,
+        (
+            all_fields.index(config.kyujitai_field)
+            if config.kyujitai_field in all_fields
+            else None
+        ),
+        is_dirty,
+        max_previous_js_version,
+    )
+
+
+def get_notetype_plans(config: Config, js: str) -> dict[NotetypeId, NotetypePlan]:
+    """Return the plans of the note types with hanzi fields.
+
+    Plans are kept in `user_files' along with the modification time of their note
+    type, so that only note types which changed since they were planned are fetched
+    and matched again.
+    """
+    if not config.hanzi_fields_regexp:
+        return {}
+    # Plans saved with other fields can't be loaded, so they are part of the key.
+    plan_fields = ",".join(x.name for x in dataclass_fields(NotetypePlan))
+    key = hashlib.blake2b(
+        f"{config.digest}\x1f{JS_VERSION}\x1f{plan_fields}\x1f{js}".encode("utf-8"),
+        digest_size=16,
+    ).hexdigest()
+    state = load_state(NOTETYPE_PLANS_STATE)
+    cached = state["notetypes"] if state and state.get("key") == key else {}
+    entries: dict[str, list[Any]] = {}
+    plans: dict[NotetypeId, NotetypePlan] = {}
+    for id, name, mod in mw.col.db.all("select id, name, mtime_secs from notetypes"):
+        entry = cached.get(str(id))
+        if entry and entry[0] == mod and entry[1]["name"] == name:
+            plan = NotetypePlan(**entry[1])
+        else:
+            plan = create_notetype_plan(config, js, NotetypeId(id), name)
+        entries[str(id)] = [mod, asdict(plan)]
+        if plan.hanzi_fields:
+            plans[NotetypeId(id)] = plan
+    if entries != cached:
+        save_state(NOTETYPE_PLANS_STATE, {"key": key, "notetypes": entries})
+    return plans
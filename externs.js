@@ -2,8 +2,9 @@
 function AnkiDroidJS(options) {}
 AnkiDroidJS.prototype.ankiSearchCard = function(query) {};
 
-function pycmd(string) {}
+function pycmd(string, callback) {}
 
+window.hanziwebJsVersion = 0;
 window.hanziwebHanziActions = [];
 window.hanziwebHanziTermActions = [];
 window.hanziwebPhoneticActions = [];
@@ -16,3 +17,5 @@ window.hanziwebOnClickHanziTerm = function(event, hanzi, ...nids) {};
 window.hanziwebOnClickPhonetic = function(event, hanzi, ...nids) {};
 window.hanziwebOnClickPhoneticTerm = function(event, hanzi, phonetic,
                                               ...nids) {};
+window.hanziwebOnClickMoreTerms = function(event, nid, hanzi, phonetic,
+                                           offset) {};
@@ -3,9 +3,45 @@ window.hanziwebAnkiDroid =
         ? new AnkiDroidJS({"version" : "0.0.3", "developer" : "Hanzi Web"})
         : null;
 
+// Stylesheet and popup HTML, provided by `init' and inserted into the document
+// only once a popup is actually shown.
+let popupCss = "";
+let popupHtml = "";
+
+function getPopup() {
+  // The reviewer reuses the same document across card renders, so a popup
+  // built by this version of Hanzi Web can be reused as-is.
+  const version = String(window.hanziwebJsVersion);
+  const popup = document.getElementById("hanziweb-popup");
+  if (popup !== null && popup.getAttribute("data-version") === version) {
+    return popup;
+  }
+
+  // Delete any stale elements that might have been left over from a previous
+  // version of Hanzi Web or a previous refresh of the Anki card preview.
+  for (const element of document.querySelectorAll(
+           "[id=hanziweb-style],[id=hanziweb-popup]")) {
+    element.remove();
+  }
+
+  // Insert stylesheet.
+  const styleElement = document.createElement("style");
+  styleElement.id = "hanziweb-style";
+  styleElement.textContent = popupCss;
+  document.head.appendChild(styleElement);
+
+  // Insert popup HTML.
+  document.body.insertAdjacentHTML("afterbegin", popupHtml);
+  const newPopup = document.getElementById("hanziweb-popup");
+  newPopup.setAttribute("data-version", version);
+  return newPopup;
+}
+
 function hidePopup() {
-  document.getElementById("hanziweb-popup")
-      .classList.remove("hanziweb-popup-open");
+  const popup = document.getElementById("hanziweb-popup");
+  if (popup !== null) {
+    popup.classList.remove("hanziweb-popup-open");
+  }
 }
 
 function ankiEditNote(nid) {
@@ -107,11 +143,11 @@ function handleActions(title, actions, nids, keywords) {
     return;
   }
   // Show popup.
+  const popup = getPopup();
   document.getElementById("hanziweb-popup-title").replaceChildren(title);
   document.getElementById("hanziweb-popup-actions")
       .replaceChildren(...actionsToButtons(actions, nids, keywords));
-  document.getElementById("hanziweb-popup")
-      .classList.add("hanziweb-popup-open");
+  popup.classList.add("hanziweb-popup-open");
 }
 
 function getEventLink(event) {
@@ -198,22 +234,50 @@ window.hanziwebOnClickPhoneticTerm = function(event, hanzi, phonetic, ...nids) {
   event.preventDefault();
 };
 
-function init(css, html) {
-  // Delete any stale elements that might have been left over from a previous
-  // refresh of the Anki card preview.
-  for (const element of document.querySelectorAll(
-           "[id=hanziweb-style],[id=hanziweb-popup]")) {
-    element.remove();
+function clickRowAction(link, phonetic) {
+  // Without Anki's bridge, act as if the hanzi or phonetic component of this
+  // row was clicked, which typically browses to all of its notes.
+  const selector = phonetic === "" ? "a[onclick^='hanziwebOnClickHanzi(']"
+                                   : "a[onclick^='hanziwebOnClickPhonetic(']";
+  const rowLink = link.closest("tr").querySelector(selector);
+  if (rowLink !== null) {
+    rowLink.click();
   }
+}
 
-  // Insert stylesheet.
-  // document.getElementById("hanziweb-style")?.remove();
-  const styleElement = document.createElement("style");
-  styleElement.id = "hanziweb-style";
-  styleElement.textContent = css;
-  document.head.appendChild(styleElement);
+window.hanziwebOnClickMoreTerms = function(event, nid, hanzi, phonetic,
+                                           offset) {
+  event.preventDefault();
+  const link = getEventLink(event);
+  if (window.hanziwebAnkiDroid !== null || typeof pycmd === "undefined") {
+    clickRowAction(link, phonetic);
+    return;
+  }
+  // Terms fetched by previous clicks are already shown.
+  const start = Number(link.getAttribute("data-offset") || offset);
+  pycmd("hanziwebMoreTerms " + JSON.stringify([ nid, hanzi, phonetic, start ]),
+        (result) => {
+          if (result === null) {
+            clickRowAction(link, phonetic);
+            return;
+          }
+          const terms = result["terms"];
+          for (const term of terms) {
+            link.insertAdjacentHTML("beforebegin", result["separator"] + term);
+          }
+          if (result["more"]) {
+            link.setAttribute("data-offset", String(start + terms.length));
+          } else {
+            link.remove();
+          }
+        });
+};
 
-  // Insert popup HTML.
-  // document.getElementById("hanziweb-popup")?.remove();
-  document.body.insertAdjacentHTML("afterbegin", html);
+function init(css, html) {
+  // This runs on every card render, so defer all DOM work until a popup is
+  // first shown; see `getPopup'. A popup left open on the previous card is
+  // closed, as its actions belong to that card.
+  popupCss = css;
+  popupHtml = html;
+  hidePopup();
 }
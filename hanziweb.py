@@ -1,15 +1,27 @@
 import sys
+import hashlib
 import json
 import html
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from re import Pattern
-from typing import Any, Callable, Iterable, Optional, Sequence, Collection, Tuple, Union
+from typing import (
+    Any,
+    Callable,
+    Iterable,
+    Iterator,
+    Optional,
+    Sequence,
+    Collection,
+    Tuple,
+    Union,
+)
 from functools import cached_property
+from itertools import chain, islice
 
-from anki.models import NotetypeId, NotetypeNameId
+from anki.models import NotetypeId
 from anki.notes import NoteId, Note
-from anki.cards import Card
+from anki.utils import ids2str
 from anki.consts import (
     CARD_TYPE_NEW,
     CARD_TYPE_LRN,
@@ -20,16 +32,41 @@ from aqt.utils import askUser
 
 from .common import (
     Config,
-    HANZI_REGEXP,
     JS_VERSION,
+    NoteStore,
+    NotetypePlan,
+    Phonetics,
+    ReportDialog,
     assert_is_not_none,
-    html_tag,
-    inject_js_into_html,
+    batched,
+    get_field_cache,
+    get_notetype_plans,
+    inject_into_templates,
+    load_state,
     log,
     mw,
-    normalize_unicode,
+    save_state,
 )
-from .kyujipy import BasicConverter
+
+# The rendering functions below write the HTML directly rather than through
+# html_tag, as they are called for every hanzi of every destination note. The
+# attributes are kept in the order html_tag writes them, so that fields rendered by
+# older versions compare equal.
+
+
+def html_js_string(x: str) -> str:
+    """Quote `x' as a JS string for an onclick attribute."""
+    if x.isascii() and x.isdigit():
+        # Note IDs need no escaping.
+        return f"'{x}'"
+    return html.escape(
+        json.dumps(
+            html.escape(x, quote=True),
+            ensure_ascii=False,
+            separators=(",", ":"),
+        ),
+        quote=False,
+    ).replace('"', "'")
 
 
 def html_click_action(
@@ -37,40 +74,9 @@ def html_click_action(
 ) -> str:
     if click_action == ":none":
         # Wrap in a span so that Anki doesn't place furigana over commas.
-        return html_tag("span", content)
-    json_args = ",".join(
-        [
-            html.escape(
-                json.dumps(
-                    html.escape(x, quote=True),
-                    ensure_ascii=False,
-                    separators=(",", ":"),
-                ),
-                quote=False,
-            )
-            for x in args
-        ]
-    ).replace('"', "'")
-    return html_tag("a", content, href="#", onclick=f"{function}(event,{json_args})")
-
-
-def inject_into_templates(
-    model_dict: dict[str, Any], config: Config, js: str
-) -> tuple[bool, int]:
-    max_previous_js_version = -1
-    is_dirty = False
-    for template in model_dict["tmpls"]:
-        for side in ("qfmt", "afmt"):
-            html, this_previous_js_version = inject_js_into_html(
-                config, js, template[side]
-            )
-            max_previous_js_version = max(
-                max_previous_js_version, this_previous_js_version
-            )
-            if template[side] != html:
-                is_dirty = True
-                template[side] = html
-    return is_dirty, max_previous_js_version
+        return f"<span>{content}</span>"
+    json_args = ",".join([html_js_string(x) for x in args])
+    return f'<a href="#" onclick="{function}(event,{json_args})">{content}</a>'
 
 
 @dataclass(eq=False, frozen=True)
@@ -78,40 +84,36 @@ class HanziModel:
     id: NotetypeId
     name: str
     fields: Sequence[str]
+    field_ords: Sequence[int]
     has_web_field: bool
-    model_dict: dict[str, Any]
+    # The note type with the JS injected, if that changes its templates.
+    model_dict: Optional[dict[str, Any]]
     max_previous_js_version: int
     is_dirty: bool
 
     def apply(self) -> None:
-        mw.col.models.update_dict(self.model_dict)
+        mw.col.models.update_dict(assert_is_not_none(self.model_dict))
 
 
 def create_hanzi_model(
     config: Config,
-    note_type: NotetypeNameId,
+    id: NotetypeId,
+    plan: NotetypePlan,
     js: str,
-) -> Optional[HanziModel]:
-    id = NotetypeId(note_type.id)
-    model_dict = assert_is_not_none(mw.col.models.get(id))
-    all_fields = mw.col.models.field_names(model_dict)
-    fields = (
-        [name for name in all_fields if config.hanzi_fields_regexp.fullmatch(name)]
-        if config.hanzi_fields_regexp
-        else []
-    )
-    if not fields:
-        return None
-    has_web_field = config.web_field in all_fields
-    is_dirty, max_previous_js_version = inject_into_templates(model_dict, config, js)
+) -> HanziModel:
+    model_dict = None
+    if plan.is_dirty:
+        model_dict = assert_is_not_none(mw.col.models.get(id))
+        inject_into_templates(model_dict, config, js)
     return HanziModel(
         id,
-        note_type.name,
-        fields,
-        has_web_field,
+        plan.name,
+        plan.hanzi_fields,
+        plan.hanzi_field_ords,
+        plan.has_web_field,
         model_dict,
-        max_previous_js_version,
-        is_dirty,
+        plan.max_previous_js_version,
+        plan.is_dirty,
     )
 
 
@@ -119,9 +121,7 @@ def create_hanzi_model(
 class HanziNote:
     id: NoteId
     model: HanziModel
-    fields: list[str]
     terms: Sequence[str]
-    web_field: Optional[str]
     hanzi: Sequence[str]
     phonetic_series: Sequence[str]
     order: int
@@ -130,56 +130,24 @@ class HanziNote:
 
 
 def create_hanzi_note(
-    config: Config,
     id: NoteId,
-    hanzi_models: dict[NotetypeId, HanziModel],
+    model: HanziModel,
+    terms: Sequence[str],
+    hanzi: Sequence[str],
     japanese_note_ids: set[NoteId],
-    converter: BasicConverter,
-    components_by_phonetic_series: dict[str, str],
+    phonetics: Phonetics,
+    order: int,
+    is_new: bool,
 ) -> HanziNote:
-    note = mw.col.get_note(id)
-
-    model = hanzi_models[note.mid]
-    fields = note.fields
-    web_field = note[config.web_field] if model.has_web_field else None
-
-    terms = [normalize_unicode(note[field]) for field in hanzi_models[note.mid].fields]
-
-    hanzi = []
-    for value in terms:
-        hanzi.extend(HANZI_REGEXP.findall(value))
-
     is_japanese = id in japanese_note_ids
 
-    phonetic_series = [
-        components_by_phonetic_series.get(
-            converter.shinjitai_to_kyujitai(h) if is_japanese else h  # type: ignore
-        )
-        or ""
-        for h in hanzi
-    ]
-
-    cards = note.cards()
-
-    is_new = all([card.type == CARD_TYPE_NEW for card in cards])
-
-    def get_order(card: Card) -> int:
-        if card.type == CARD_TYPE_NEW:
-            return sys.maxsize
-        if card.type == CARD_TYPE_LRN or card.type == CARD_TYPE_RELEARNING:
-            return -1
-        if card.type == CARD_TYPE_REV:
-            return card.due
-        raise Exception(f"Unknown card type: {card.type}")
-
-    order = min([get_order(card) for card in cards])
+    components = phonetics.japanese_components if is_japanese else phonetics.components
+    phonetic_series = [components.get(h, "") for h in hanzi]
 
     return HanziNote(
         id,
         model,
-        fields,
         terms,
-        web_field,
         hanzi,
         phonetic_series,
         order,
@@ -188,105 +156,492 @@ def create_hanzi_note(
     )
 
 
+# Number of notes whose fields or cards are read at once.
+HANZI_NOTE_BATCH_SIZE = 1000
+
+
+def parse_hanzi_fields(
+    ids: Iterable[NoteId],
+    hanzi_models: dict[NotetypeId, HanziModel],
+) -> Iterator[Tuple[NoteId, HanziModel, list[str], list[str]]]:
+    """Yield the model, terms and hanzi of each note, read from the database."""
+    field_cache = get_field_cache()
+    for batch in batched(ids, HANZI_NOTE_BATCH_SIZE):
+        rows = [
+            (id, hanzi_models[mid], flds.split("\x1f"))
+            for id, mid, flds in mw.col.db.all(
+                f"select id, mid, flds from notes where id in {ids2str(batch)}"
+            )
+        ]
+        parsed_fields = iter(
+            field_cache.parse(
+                [
+                    (id, field, fields[ord])
+                    for id, model, fields in rows
+                    for field, ord in zip(model.fields, model.field_ords)
+                ]
+            )
+        )
+        for id, model, _ in rows:
+            parsed = list(islice(parsed_fields, len(model.fields)))
+            yield (
+                NoteId(id),
+                model,
+                [x.text for x in parsed],
+                [h for x in parsed for h in x.hanzi],
+            )
+
+
+def get_card_orders(ids: Iterable[NoteId]) -> dict[NoteId, Tuple[int, bool]]:
+    """Return the order in which the terms of each note are listed, and whether all
+    of its cards are new.
+    """
+
+    def get_order(type: int, due: int) -> int:
+        if type == CARD_TYPE_NEW:
+            return sys.maxsize
+        if type == CARD_TYPE_LRN or type == CARD_TYPE_RELEARNING:
+            return -1
+        if type == CARD_TYPE_REV:
+            return due
+        raise Exception(f"Unknown card type: {type}")
+
+    orders: dict[NoteId, Tuple[int, bool]] = {}
+    for batch in batched(ids, HANZI_NOTE_BATCH_SIZE):
+        for id, type, due in mw.col.db.all(
+            f"select nid, type, due from cards where nid in {ids2str(batch)}"
+        ):
+            order, is_new = orders.get(id, (sys.maxsize, True))
+            orders[id] = (
+                min(order, get_order(type, due)),
+                is_new and type == CARD_TYPE_NEW,
+            )
+    return orders
+
+
 @dataclass(eq=False, frozen=True)
 class HanziWeb:
-    web: dict[str, list[HanziNote]]
+    # The notes indexed under each key, as ascending ranks in `notes'.
+    web: dict[str, list[int]]
+    # Studied notes, ranked in the order in which their terms are listed.
+    notes: Sequence[HanziNote]
+    ranks: dict[NoteId, int]
+    # Number of hanzi in notes which have been studied, whether or not they are
+    # indexed in `web'.
+    seen_hanzi: int
     total_hanzi: int
+    _rank_sets: dict[str, frozenset[int]] = field(default_factory=dict, repr=False)
+
+    def rank_set(self, key: str) -> frozenset[int]:
+        """Return the ranks of the notes indexed under `key', as a set."""
+        rank_set = self._rank_sets.get(key)
+        if rank_set is None:
+            rank_set = self._rank_sets[key] = frozenset(self.web.get(key, ()))
+        return rank_set
+
+    def note_ranks(self, note: HanziNote) -> frozenset[int]:
+        rank = self.ranks.get(note.id)
+        return frozenset() if rank is None else frozenset([rank])
+
+    def select(self, key: str, exclude: Collection[int]) -> list[HanziNote]:
+        """Return the notes indexed under `key', except for those ranked in
+        `exclude'.
+        """
+        notes = self.notes
+        return [notes[rank] for rank in self.web.get(key, ()) if rank not in exclude]
 
     def entry(
         self,
         term_separator: str,
         max_terms_per_hanzi: int,
         hanzi: str,
-        select: Callable[[HanziNote], bool],
+        exclude: Collection[int],
         filter: Callable[[str, NoteId], str],
-    ) -> Tuple[str, list[NoteId]]:
-        note_list = self.web.get(hanzi)
+    ) -> Tuple[str, list[NoteId], bool]:
+        """Return the terms of the selected notes, their IDs, and whether any of
+        their terms were left out because of `max_terms_per_hanzi'.
+        """
+        note_list = self.select(hanzi, exclude)
         if not note_list:
-            return "", []
+            return "", [], False
         terms: list[str] = []
-        ids: list[NoteId] = []
-        # TODO: Do this smarter
-        reached_term_limit: Callable[[], bool] = (
-            (lambda: False)
-            if max_terms_per_hanzi == 0
-            else (lambda: len(terms) >= max_terms_per_hanzi)
-        )
+        has_more = False
         for other_hanzi_note in note_list:
-            if not select(other_hanzi_note):
+            if max_terms_per_hanzi and len(terms) >= max_terms_per_hanzi:
+                if other_hanzi_note.terms:
+                    has_more = True
+                    break
                 continue
-            if not reached_term_limit():
-                for term in other_hanzi_note.terms:
-                    if reached_term_limit():
-                        break
-                    terms.append(filter(term, other_hanzi_note.id))
-            ids.append(other_hanzi_note.id)
-        ids.sort()
-        return term_separator.join(terms), ids
+            for term in other_hanzi_note.terms:
+                if max_terms_per_hanzi and len(terms) >= max_terms_per_hanzi:
+                    has_more = True
+                    break
+                terms.append(filter(term, other_hanzi_note.id))
+        ids = sorted(x.id for x in note_list)
+        return term_separator.join(terms), ids, has_more
+
+    def iter_terms(
+        self, hanzi: str, exclude: Collection[int]
+    ) -> Iterator[Tuple[str, NoteId]]:
+        """Iterate over all the terms of the selected notes, in the order of `entry'."""
+        for other_hanzi_note in self.select(hanzi, exclude):
+            for term in other_hanzi_note.terms:
+                yield term, other_hanzi_note.id
 
 
 def create_hanzi_web(
-    notes: Iterable[HanziNote], field: Callable[[HanziNote], set[str]]
+    notes: Iterable[HanziNote],
+    field: Callable[[HanziNote], set[str]],
+    keys: Optional[Collection[str]] = None,
 ) -> HanziWeb:
+    """Index the studied notes by each of their hanzi, or only by those in `keys'."""
     total_hanzi: set[str] = set()
-    hanzi_sets: dict[str, set[HanziNote]] = {}
+    seen_hanzi: set[str] = set()
+    studied_notes: list[Tuple[HanziNote, set[str]]] = []
     for hanzi_note in notes:
         all_hanzi = field(hanzi_note)
         total_hanzi.update(all_hanzi)
         # Skip this one if we've never seen it.
         if hanzi_note.is_new:
             continue
-        for hanzi in all_hanzi:
-            note_set = hanzi_sets.get(hanzi)
-            if note_set:
-                note_set.add(hanzi_note)
+        seen_hanzi.update(all_hanzi)
+        studied_notes.append((hanzi_note, all_hanzi))
+    # Ranking the notes once keeps every posting list sorted as it is built.
+    studied_notes.sort(key=lambda x: (x[0].order, x[0].id))
+    web: dict[str, list[int]] = {}
+    for rank, (hanzi_note, all_hanzi) in enumerate(studied_notes):
+        for hanzi in all_hanzi if keys is None else all_hanzi.intersection(keys):
+            posting_list = web.get(hanzi)
+            if posting_list:
+                posting_list.append(rank)
             else:
-                hanzi_sets[hanzi] = {hanzi_note}
-    web = {
-        hanzi: sorted(
-            note_set,
-            key=lambda x: (x.order, x.id),
-        )
-        for (hanzi, note_set) in hanzi_sets.items()
+                web[hanzi] = [rank]
+    ranked_notes = [hanzi_note for hanzi_note, _ in studied_notes]
+    return HanziWeb(
+        web,
+        ranked_notes,
+        {hanzi_note.id: rank for rank, hanzi_note in enumerate(ranked_notes)},
+        len(seen_hanzi),
+        len(total_hanzi),
+    )
+
+
+def create_phonetic_series_web(
+    notes: Iterable[HanziNote],
+    hanzi_web: HanziWeb,
+    phonetics: Phonetics,
+    keys: Optional[Collection[str]] = None,
+) -> HanziWeb:
+    """Create the web of phonetic series from the web of hanzi.
+
+    Instead of indexing every note again, the notes of a phonetic series are those
+    listed in the hanzi web under its members. If only the components in `keys' are
+    indexed, the hanzi web must index all of their members. Both webs share the
+    ranks of their notes.
+    """
+    total_components: set[str] = set()
+    seen_components: set[str] = set()
+    for note in notes:
+        components = {p for s in note.phonetic_series for p in s}
+        total_components.update(components)
+        if not note.is_new:
+            seen_components.update(components)
+    studied_hanzi = hanzi_web.web.keys()
+    japanese_ranks = {
+        rank for rank, note in enumerate(hanzi_web.notes) if note.is_japanese
     }
-    return HanziWeb(web, len(total_hanzi))
+    web: dict[str, list[int]] = {}
+    for component in (
+        total_components if keys is None else total_components.intersection(keys)
+    ):
+        rank_set: set[int] = set()
+        for hanzi in studied_hanzi & phonetics.series.get(component, frozenset()):
+            rank_set.update(hanzi_web.web[hanzi])
+        rank_set -= japanese_ranks
+        japanese_rank_set: set[int] = set()
+        for hanzi in studied_hanzi & phonetics.japanese_series.get(
+            component, frozenset()
+        ):
+            japanese_rank_set.update(hanzi_web.web[hanzi])
+        rank_set |= japanese_rank_set & japanese_ranks
+        if rank_set:
+            web[component] = sorted(rank_set)
+    return HanziWeb(
+        web,
+        hanzi_web.notes,
+        hanzi_web.ranks,
+        len(seen_components),
+        len(total_components),
+    )
 
 
 def get_hanzi_models(config: Config, js: str) -> dict[NotetypeId, HanziModel]:
-    if not config.hanzi_fields_regexp:
-        return {}
     return {
-        model.id: model
-        for model in [
-            create_hanzi_model(
-                config,
-                note_type,
-                js,
-            )
-            for note_type in mw.col.models.all_names_and_ids()
-        ]
-        if model
+        id: create_hanzi_model(config, id, plan, js)
+        for id, plan in get_notetype_plans(config, js).items()
     }
 
 
-def get_notes_to_update(
-    config: Config,
-    notes: dict[NoteId, HanziNote],
-    destination_note_ids: set[NoteId],
-    hanzi_web: HanziWeb,
-    phonetic_series_web: HanziWeb,
-    onyomi: dict[str, list[Tuple[str, list[str]]]],
-) -> list[tuple[HanziNote, str]]:
-    def build_phonetic_series_entry(
-        hanzi_note: HanziNote, component: str
-    ) -> Tuple[str, str]:
-        terms_text, ids = phonetic_series_web.entry(
-            config.term_separator,
-            config.max_terms_per_hanzi,
+def html_more_terms_link(term_separator: str, args: list[str]) -> str:
+    json_args = ",".join([html_js_string(x) for x in args])
+    return (
+        f'<a href="#" class="hanziweb-more" '
+        f'onclick="hanziwebOnClickMoreTerms(event,{json_args})">'
+        f"{term_separator}…</a>"
+    )
+
+
+def html_term_cells(clazz: str, kind_text: str, terms_text: str) -> str:
+    if not kind_text:
+        return f'<td colspan="2" class="{clazz} hanziweb-terms">{terms_text}</td>'
+    return (
+        f'<td class="{clazz} hanziweb-kind">{kind_text}</td>'
+        f'<td class="{clazz} hanziweb-terms">{terms_text}</td>'
+    )
+
+
+class OnyomiCells:
+    """Rendered cells of the on'yomi rows of each kanji.
+
+    The rows only depend on the on'yomi data and the term separator, so they are
+    rendered once and shared by every note and run.
+    """
+
+    onyomi: dict[str, list[Tuple[str, list[str]]]]
+    term_separator: str
+    cells: dict[str, list[str]]
+
+    def __init__(
+        self, onyomi: dict[str, list[Tuple[str, list[str]]]], term_separator: str
+    ):
+        self.onyomi = onyomi
+        self.term_separator = term_separator
+        self.cells = {}
+
+    def get(self, kanji: str) -> list[str]:
+        cells = self.cells.get(kanji)
+        if cells is None:
+            cells = [
+                html_term_cells(
+                    "hanziweb-onyomi", kind, self.term_separator.join(readings)
+                )
+                for kind, readings in self.onyomi.get(kanji) or []
+            ]
+            self.cells[kanji] = cells
+        return cells
+
+
+_onyomi_cells: Optional[OnyomiCells] = None
+
+
+def get_onyomi_cells(
+    onyomi: dict[str, list[Tuple[str, list[str]]]], term_separator: str
+) -> OnyomiCells:
+    global _onyomi_cells
+    if (
+        not _onyomi_cells
+        or _onyomi_cells.onyomi is not onyomi
+        or _onyomi_cells.term_separator != term_separator
+    ):
+        _onyomi_cells = OnyomiCells(onyomi, term_separator)
+    return _onyomi_cells
+
+
+WEB_DIGESTS_STATE = "web-digests"
+
+
+def digest_web_field(value: str) -> str:
+    return hashlib.blake2b(value.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class WebDigests:
+    """Digests of the Hanzi Web fields of destination notes, kept across runs.
+
+    A digest is recorded along with the modification time of its note, and is only
+    trusted while the note is unmodified. Otherwise the field is hashed again. All
+    digests are dropped if they were taken from another field.
+    """
+
+    def __init__(self, field: str) -> None:
+        self.field = field
+        state = load_state(WEB_DIGESTS_STATE)
+        if not state or state.get("field") != field:
+            state = {"notes": {}}
+        self._entries: dict[NoteId, Tuple[int, str]] = {
+            NoteId(int(id)): (mod, digest)
+            for id, (mod, digest) in state["notes"].items()
+        }
+        self._written: dict[NoteId, str] = {}
+        self._is_dirty = False
+
+    def get(self, id: NoteId, mod: int, read_field: Callable[[], str]) -> str:
+        """Return the digest of the field of a note last modified at `mod'. The field
+        is only read with `read_field' if its digest is not known.
+        """
+        entry = self._entries.get(id)
+        if entry and entry[0] == mod:
+            return entry[1]
+        digest = digest_web_field(read_field())
+        self._entries[id] = (mod, digest)
+        self._is_dirty = True
+        return digest
+
+    def stage(self, id: NoteId, digest: str) -> None:
+        """Record the digest of a field which is about to be written."""
+        self._written[id] = digest
+
+    def save(self) -> None:
+        """Save the digests, once the fields staged with `stage' are written."""
+        if self._written:
+            # The notes have new modification times now.
+            for id, mod in mw.col.db.all(
+                f"select id, mod from notes where id in {ids2str(self._written)}"
+            ):
+                self._entries[id] = (mod, self._written[id])
+            self._written.clear()
+            self._is_dirty = True
+        if self._is_dirty:
+            save_state(
+                WEB_DIGESTS_STATE,
+                {
+                    "field": self.field,
+                    "notes": {
+                        str(id): list(entry) for id, entry in self._entries.items()
+                    },
+                },
+            )
+            self._is_dirty = False
+
+
+STICKY_TERMS_STATE = "sticky-terms"
+
+
+class StickyTerms:
+    """The notes whose terms each hanzi and phonetic series listed in the previous
+    run.
+
+    Those notes keep being listed first, in the same order, unless more than
+    `tolerance' other notes would now be listed instead. Fields then don't change
+    just because reviews moved the due dates of the notes they list.
+    """
+
+    def __init__(self, tolerance: int):
+        self.tolerance = tolerance
+        state = load_state(STICKY_TERMS_STATE) or {}
+        self._heads: dict[str, dict[str, list[NoteId]]] = {
+            kind: state.get(kind, {}) for kind in ("hanzi", "phonetic")
+        }
+        # Keys whose listed notes were kept although they would have changed.
+        self._held_keys: dict[str, set[str]] = {"hanzi": set(), "phonetic": set()}
+        # Number of notes left as they are only because of held keys.
+        self.num_avoided_writes = 0
+
+    def apply(self, kind: str, web: HanziWeb, max_terms_per_hanzi: int) -> None:
+        """Reorder the notes of `web' to list the previous ones first, where they are
+        held.
+        """
+        notes = web.notes
+
+        def head(ranks: list[int]) -> list[int]:
+            """Return the notes whose terms are listed, before any are excluded."""
+            result = []
+            num_terms = 0
+            for rank in ranks:
+                if max_terms_per_hanzi and num_terms >= max_terms_per_hanzi:
+                    break
+                if notes[rank].terms:
+                    result.append(rank)
+                    num_terms += len(notes[rank].terms)
+            return result
+
+        heads = self._heads[kind]
+        held_keys = self._held_keys[kind]
+        for key, ranks in web.web.items():
+            current_head = head(ranks)
+            previous_ids = heads.get(key)
+            if previous_ids:
+                rank_set = set(ranks)
+                previous_head = [
+                    rank
+                    for id in previous_ids
+                    if (rank := web.ranks.get(id)) is not None and rank in rank_set
+                ]
+                if (
+                    previous_head
+                    and len(set(current_head).difference(previous_head))
+                    <= self.tolerance
+                ):
+                    previous_set = set(previous_head)
+                    ranks = previous_head + [x for x in ranks if x not in previous_set]
+                    web.web[key] = ranks
+                    held_head = head(ranks)
+                    if held_head != current_head:
+                        held_keys.add(key)
+                        current_head = held_head
+            heads[key] = [notes[rank].id for rank in current_head]
+
+    def is_held(self, hanzi_note: HanziNote) -> bool:
+        return any(x in self._held_keys["hanzi"] for x in hanzi_note.hanzi) or any(
+            x in self._held_keys["phonetic"]
+            for components in hanzi_note.phonetic_series
+            for x in components
+        )
+
+    def save(self) -> None:
+        save_state(STICKY_TERMS_STATE, self._heads)
+
+
+@dataclass(eq=False, frozen=True)
+class HanziWebIndex:
+    """Hanzi notes and the webs built from them, from which fields are rendered."""
+
+    config: Config
+    notes: dict[NoteId, HanziNote]
+    # Notes whose rows are indexed, if not all of them.
+    destination_note_ids: Optional[Collection[NoteId]]
+    hanzi_web: HanziWeb
+    phonetic_series_web: HanziWeb
+    onyomi_cells: OnyomiCells
+
+    def get_renderable(self, note_id: NoteId) -> Optional[HanziNote]:
+        if (
+            self.destination_note_ids is not None
+            and note_id not in self.destination_note_ids
+        ):
+            return None
+        return self.notes.get(note_id)
+
+    def _row(self, hanzi_note: HanziNote, hanzi: str, component: str) -> Tuple[
+        HanziWeb,
+        str,
+        Collection[int],
+        Callable[[str, NoteId], str],
+    ]:
+        """Return the web, key, excluded note ranks and term rendering of a row.
+
+        Rows of phonetic series have a `component'; the row of the hanzi itself has
+        none.
+        """
+        config = self.config
+        if not component:
+            return (
+                self.hanzi_web,
+                hanzi,
+                self.hanzi_web.note_ranks(hanzi_note),
+                lambda term, nid: html_click_action(
+                    term,
+                    config.click_hanzi_term_action,
+                    "hanziwebOnClickHanziTerm",
+                    [hanzi, str(nid)],
+                ),
+            )
+        return (
+            self.phonetic_series_web,
             component,
             # Exclude any other entries that contain the exact same hanzi as this
-            # one; it just creates noise in the output.
-            lambda x: x != hanzi_note and hanzi not in x.hanzi,
+            # one; it just creates noise in the output. This one is among them if
+            # it has been studied.
+            self.hanzi_web.rank_set(hanzi),
             lambda term, nid: html_click_action(
                 term,
                 config.click_phonetic_term_action,
@@ -294,175 +649,382 @@ def get_notes_to_update(
                 [hanzi, component, str(nid)],
             ),
         )
-        component_text = "音符 " + html_tag(
-            "span", component, clazz="hanziweb-phonetic-component"
+
+    def _terms_text(
+        self, hanzi_note: HanziNote, hanzi: str, component: str
+    ) -> Tuple[str, list[NoteId]]:
+        config = self.config
+        web, key, exclude, filter = self._row(hanzi_note, hanzi, component)
+        terms_text, ids, has_more = web.entry(
+            config.term_separator, config.max_terms_per_hanzi, key, exclude, filter
+        )
+        if has_more and config.more_terms_link and config.js_required:
+            # The rest of the terms are fetched by the JS when this is clicked.
+            terms_text += html_more_terms_link(
+                config.term_separator,
+                [str(hanzi_note.id), hanzi, component, str(config.max_terms_per_hanzi)],
+            )
+        return terms_text, ids
+
+    def iter_terms(
+        self, hanzi_note: HanziNote, hanzi: str, component: str
+    ) -> Iterator[str]:
+        """Iterate over all the rendered terms of a row, including those left out of
+        the field by `max_terms_per_hanzi'.
+        """
+        web, key, exclude, filter = self._row(hanzi_note, hanzi, component)
+        for term, nid in web.iter_terms(key, exclude):
+            yield filter(term, nid)
+
+    def _phonetic_series_entry(
+        self, hanzi_note: HanziNote, hanzi: str, component: str
+    ) -> Tuple[str, str]:
+        terms_text, ids = self._terms_text(hanzi_note, hanzi, component)
+        component_text = (
+            f'音符 <span class="hanziweb-phonetic-component">{component}</span>'
         )
         return (
             html_click_action(
                 component_text,
-                config.click_phonetic_action,
+                self.config.click_phonetic_action,
                 "hanziwebOnClickPhonetic",
                 [hanzi, *[str(id) for id in ids]],
             ),
             terms_text,
         )
 
-    notes_to_update = []
-    for note_id in destination_note_ids:
-        hanzi_note = notes[note_id]
-        if not hanzi_note.model.has_web_field:
-            continue
-        entries: list[str] = []
+    def render(self, hanzi_note: HanziNote) -> str:
+        config = self.config
+        # The field is written into a single buffer, which is joined once.
+        parts = ['<table class="hanziweb"><tbody>']
         for hanzi, phonetic_components in zip(
             hanzi_note.hanzi, hanzi_note.phonetic_series
         ):
-            this_onyomi = (onyomi.get(hanzi) or []) if hanzi_note.is_japanese else []
+            same_terms_text, same_terms_ids = self._terms_text(hanzi_note, hanzi, "")
 
-            same_terms_text, same_terms_ids = hanzi_web.entry(
-                config.term_separator,
-                config.max_terms_per_hanzi,
-                hanzi,
-                lambda x: x != hanzi_note,
-                lambda term, nid: html_click_action(
-                    term,
-                    config.click_hanzi_term_action,
-                    "hanziwebOnClickHanziTerm",
-                    [hanzi, str(nid)],
-                ),
-            )
-
-            all_terms = (
-                ([("hanziweb-same", "", same_terms_text)] if same_terms_text else [])
+            all_cells = (
+                (
+                    [html_term_cells("hanziweb-same", "", same_terms_text)]
+                    if same_terms_text
+                    else []
+                )
                 + [
-                    (
+                    html_term_cells(
                         "hanziweb-phonetic-series",
-                        *build_phonetic_series_entry(hanzi_note, component),
+                        *self._phonetic_series_entry(hanzi_note, hanzi, component),
                     )
                     for component in phonetic_components
                 ]
-                + [
-                    ("hanziweb-onyomi", kind, config.term_separator.join(readings))
-                    for (kind, readings) in this_onyomi
-                ]
+                + (self.onyomi_cells.get(hanzi) if hanzi_note.is_japanese else [])
             )
 
-            hanzi_td = html_tag(
-                "td",
+            parts += (
+                '<tr><td rowspan="',
+                str(max(len(all_cells), 1)),
+                '" class="hanziweb-hanzi">',
                 html_click_action(
                     hanzi,
                     config.click_hanzi_action,
                     "hanziwebOnClickHanzi",
                     [str(id) for id in same_terms_ids],
                 ),
-                clazz="hanziweb-hanzi",
-                rowspan=str(max(len(all_terms), 1)),
+                "</td>",
             )
 
-            if len(all_terms) == 0:
-                entries.append(
-                    html_tag("tr", hanzi_td + html_tag("td", "", colspan="2"))
-                )
+            if len(all_cells) == 0:
+                parts.append('<td colspan="2"></td></tr>')
                 continue
 
-            for clazz, kind_td_text, terms_td_text in all_terms:
-                kind_td = (
-                    html_tag(
-                        "td",
-                        kind_td_text,
-                        clazz=f"{clazz} hanziweb-kind",
-                    )
-                    if kind_td_text
-                    else ""
-                )
-                terms_td = (
-                    html_tag(
-                        "td",
-                        terms_td_text,
-                        clazz=f"{clazz} hanziweb-terms",
-                    )
-                    if kind_td_text
-                    else html_tag(
-                        "td",
-                        terms_td_text,
-                        clazz=f"{clazz} hanziweb-terms",
-                        colspan="2",
-                    )
+            parts += (all_cells[0], "</tr>")
+            for cells in all_cells[1:]:
+                parts += ("<tr>", cells, "</tr>")
+        parts.append("</tbody></table>")
+        return "".join(parts)
+
+
+def create_hanzi_web_index(
+    config: Config,
+    ids: Iterable[NoteId],
+    destination_note_ids: Collection[NoteId],
+    hanzi_models: dict[NotetypeId, HanziModel],
+    japanese_note_ids: set[NoteId],
+    phonetics: Phonetics,
+    onyomi: dict[str, list[Tuple[str, list[str]]]],
+    sticky_terms: Optional[StickyTerms] = None,
+) -> HanziWebIndex:
+    log("Parsing notes")
+    parsed_notes = list(parse_hanzi_fields(ids, hanzi_models))
+
+    hanzi_keys: Optional[set[str]] = None
+    component_keys: Optional[set[str]] = None
+    indexed_note_ids: Optional[Collection[NoteId]] = None
+    if len(destination_note_ids) < len(parsed_notes):
+        # Only the rows of destination notes are rendered, so only index their hanzi
+        # and phonetic series, along with the members of those series.
+        hanzi_keys = set()
+        component_keys = set()
+        for id, _, _, hanzi in parsed_notes:
+            if id in destination_note_ids:
+                components = (
+                    phonetics.japanese_components
+                    if id in japanese_note_ids
+                    else phonetics.components
                 )
-                entries.append(html_tag("tr", hanzi_td + kind_td + terms_td))
-                hanzi_td = ""
+                hanzi_keys.update(hanzi)
+                for h in hanzi:
+                    component_keys.update(components.get(h, ""))
+        for component in component_keys:
+            hanzi_keys.update(phonetics.series.get(component, ()))
+            hanzi_keys.update(phonetics.japanese_series.get(component, ()))
+        indexed_note_ids = destination_note_ids
+
+    log("Reading cards")
+    # Only the cards of notes which may be listed are read. The others are source
+    # notes, which are studied since they have cards under review.
+    card_orders = get_card_orders(
+        id
+        for id, _, _, hanzi in parsed_notes
+        if hanzi_keys is None
+        or id in destination_note_ids
+        or not hanzi_keys.isdisjoint(hanzi)
+    )
+
+    log("Creating HanziNotes")
+    notes = {
+        id: create_hanzi_note(
+            id,
+            model,
+            terms,
+            hanzi,
+            japanese_note_ids,
+            phonetics,
+            *card_orders.get(id, (sys.maxsize, False)),
+        )
+        for id, model, terms, hanzi in parsed_notes
+    }
+
+    log("Creating HanziWebs")
+    hanzi_web = create_hanzi_web(notes.values(), lambda x: set(x.hanzi), hanzi_keys)
+    phonetic_series_web = create_phonetic_series_web(
+        notes.values(), hanzi_web, phonetics, component_keys
+    )
+    if sticky_terms:
+        sticky_terms.apply("hanzi", hanzi_web, config.max_terms_per_hanzi)
+        sticky_terms.apply("phonetic", phonetic_series_web, config.max_terms_per_hanzi)
+
+    return HanziWebIndex(
+        config,
+        notes,
+        indexed_note_ids,
+        hanzi_web,
+        phonetic_series_web,
+        get_onyomi_cells(onyomi, config.term_separator),
+    )
 
-        # Add to the list if the fields differ.
-        entries_str = html_tag(
-            "table", html_tag("tbody", "".join(entries)), clazz="hanziweb"
+
+def iter_notes_to_update(
+    store: NoteStore,
+    web_digests: WebDigests,
+    index: HanziWebIndex,
+    destination_note_ids: set[NoteId],
+    sticky_terms: Optional[StickyTerms] = None,
+) -> Iterator[tuple[HanziNote, str]]:
+    for batch in batched(destination_note_ids, NOTE_WRITE_BATCH_SIZE):
+        # Notes are only loaded if the digest of their field is unknown.
+        mods = dict(
+            mw.col.db.all(f"select id, mod from notes where id in {ids2str(batch)}")
+        )
+        for note_id in batch:
+            # Skip notes deleted since the search, as streamed notes are rendered long
+            # after it.
+            hanzi_note = index.notes.get(note_id)
+            mod = mods.get(note_id)
+            if hanzi_note is None or mod is None or not hanzi_note.model.has_web_field:
+                continue
+            # Add to the list if the fields differ.
+            entries_str = index.render(hanzi_note)
+            digest = digest_web_field(entries_str)
+            if digest != web_digests.get(
+                note_id,
+                mod,
+                lambda: store.get(note_id)[web_digests.field],
+            ):
+                web_digests.stage(note_id, digest)
+                yield hanzi_note, entries_str
+            elif sticky_terms and sticky_terms.is_held(hanzi_note):
+                sticky_terms.num_avoided_writes += 1
+
+
+# Template filter rendering the Hanzi Web of a card when it is shown, as in
+# `{{hanziweb:HanziWeb}}'.
+WEB_FIELD_FILTER = "hanziweb"
+
+# Index of the last run, kept for the rest of the session to render Hanzi Web tables
+# when cards are shown and to fetch the terms behind "more" links.
+_session_index: Optional[HanziWebIndex] = None
+
+
+def get_session_index() -> Optional[HanziWebIndex]:
+    return _session_index
+
+
+def set_session_index(index: Optional[HanziWebIndex]) -> None:
+    global _session_index
+    _session_index = index
+
+
+def render_on_display(field_text: str, field_name: str, note_id: NoteId) -> str:
+    """Render the Hanzi Web of a note from the session index, for `WEB_FIELD_FILTER'.
+
+    The text of the field is returned as is if the note is not in the index.
+    """
+    index = _session_index
+    if (
+        index is None
+        or not index.config.render_on_display
+        or field_name != index.config.web_field
+    ):
+        return field_text
+    hanzi_note = index.get_renderable(note_id)
+    if hanzi_note is None or not hanzi_note.model.has_web_field:
+        return field_text
+    return index.render(hanzi_note)
+
+
+# Number of terms returned for each click of a "more" link.
+MORE_TERMS_PAGE_SIZE = 20
+
+
+def get_more_terms(
+    note_id: str, hanzi: str, component: str, offset: int
+) -> Optional[dict[str, Any]]:
+    """Return the next page of terms of a row, after the first `offset'.
+
+    Returns None if the session index is not available or does not know the note, in
+    which case the JS falls back to the action of the row.
+    """
+    index = _session_index
+    if index is None:
+        return None
+    hanzi_note = index.get_renderable(NoteId(int(note_id)))
+    if hanzi_note is None:
+        return None
+    terms = list(
+        islice(
+            index.iter_terms(hanzi_note, hanzi, component),
+            offset,
+            offset + MORE_TERMS_PAGE_SIZE + 1,
         )
-        if entries_str != hanzi_note.web_field:
-            notes_to_update.append((hanzi_note, entries_str))
+    )
+    return {
+        "terms": terms[:MORE_TERMS_PAGE_SIZE],
+        "separator": index.config.term_separator,
+        "more": len(terms) > MORE_TERMS_PAGE_SIZE,
+    }
+
+
+# Number of notes written at once by streaming runs.
+NOTE_WRITE_BATCH_SIZE = 500
 
-    return notes_to_update
+
+# Number of notes whose labels are looked up at once, a page of the report details.
+REPORT_DETAILS_BATCH_SIZE = ReportDialog.PAGE_SIZE
 
 
 class PendingChanges:
     config: Config
+    store: NoteStore
     models_to_update: Sequence[HanziModel]
     notes_to_update: Sequence[Tuple[HanziNote, str]]
+    # Notes to update which have yet to be rendered, when streaming.
+    streamed_notes_to_update: Optional[Iterator[Tuple[HanziNote, str]]]
+    num_streamed_notes: int
+    index: HanziWebIndex
     hanzi_web: HanziWeb
     phonetic_series_web: HanziWeb
+    web_digests: WebDigests
+    sticky_terms: Optional[StickyTerms]
     num_source_notes: int
     num_destination_notes: int
 
     def __init__(
         self,
         config: Config,
+        store: NoteStore,
         source_note_ids: set[NoteId],
         destination_note_ids: set[NoteId],
         japanese_note_ids: set[NoteId],
         hanzi_models: dict[NotetypeId, HanziModel],
-        phonetics: dict[str, str],
+        phonetics: Phonetics,
         onyomi: dict[str, list[Tuple[str, list[str]]]],
+        is_streaming: bool = False,
+        write_web_field: bool = True,
     ):
+        """If `is_streaming' is set, notes to update are not rendered up front, but
+        in batches by `apply', which also writes each batch as soon as it is rendered.
+        Beyond whether there are any, nothing is then known about them before `apply',
+        so this is for runs without a report.
+
+        Unless `write_web_field' is set, only the index is built and no note is
+        updated.
+        """
         self.config = config
+        self.store = store
         self.num_source_notes = len(source_note_ids)
         self.num_destination_notes = len(destination_note_ids)
 
-        converter = BasicConverter()  # type: ignore
-
         self.models_to_update = [x for x in hanzi_models.values() if x.is_dirty]
 
-        log("Creating HanziNotes")
-        notes = {
-            id: create_hanzi_note(
-                config,
-                id,
-                hanzi_models,
-                japanese_note_ids,
-                converter,
-                phonetics,
-            )
-            for id in source_note_ids.union(destination_note_ids)
-        }
-
-        log("Creating HanziWebs")
-        self.hanzi_web = create_hanzi_web(notes.values(), lambda x: set(x.hanzi))
-        self.phonetic_series_web = create_hanzi_web(
-            notes.values(),
-            lambda x: {p for s in x.phonetic_series for p in s},
+        self.sticky_terms = (
+            StickyTerms(config.sticky_terms_tolerance) if config.sticky_terms else None
         )
-
-        log("Finding notes to update")
-        self.notes_to_update = get_notes_to_update(
+        self.index = create_hanzi_web_index(
             config,
-            notes,
+            source_note_ids.union(destination_note_ids),
             destination_note_ids,
-            self.hanzi_web,
-            self.phonetic_series_web,
+            hanzi_models,
+            japanese_note_ids,
+            phonetics,
             onyomi,
+            self.sticky_terms,
         )
+        self.hanzi_web = self.index.hanzi_web
+        self.phonetic_series_web = self.index.phonetic_series_web
+
+        self.web_digests = WebDigests(config.web_field)
+        notes_to_update = iter_notes_to_update(
+            store,
+            self.web_digests,
+            self.index,
+            destination_note_ids,
+            self.sticky_terms,
+        )
+        self.num_streamed_notes = 0
+        if not write_web_field:
+            self.notes_to_update = []
+            self.streamed_notes_to_update = None
+        elif is_streaming:
+            self.notes_to_update = []
+            # Render up to the first note to update, so that runs which change
+            # nothing are known to be empty before anything is applied.
+            first = next(notes_to_update, None)
+            self.streamed_notes_to_update = (
+                None if first is None else chain([first], notes_to_update)
+            )
+        else:
+            log("Finding notes to update")
+            self.notes_to_update = list(notes_to_update)
+            self.streamed_notes_to_update = None
 
         log("Done")
 
     @property
     def is_empty(self) -> bool:
-        return not self.models_to_update and not self.notes_to_update
+        return (
+            not self.models_to_update
+            and not self.notes_to_update
+            and self.streamed_notes_to_update is None
+        )
 
     def confirm(self) -> bool:
         downgraded_models = [
@@ -481,7 +1043,7 @@ class PendingChanges:
     @property
     def report(self) -> str:
         def unique_hanzi(web: HanziWeb) -> str:
-            return f"{len(web.web)} seen, {web.total_hanzi} total"
+            return f"{web.seen_hanzi} seen, {web.total_hanzi} total"
 
         report = [
             f"== Hanzi Web.\n\n",
@@ -500,30 +1062,81 @@ class PendingChanges:
             report.append("\nAll models already up to date.\n")
         if self.notes_to_update:
             report.append(
-                f"\nNotes to update [{self.config.web_field}] ({len(self.notes_to_update)}):\n"
+                f"\nNotes to update [{self.config.web_field}]: "
+                f"{len(self.notes_to_update)}\n"
             )
-            for note, _ in self.notes_to_update:
-                report.append(f"  {note.id} {note.fields[0]}\n")
         else:
             report.append("\nAll notes already up to date.\n")
+        if self.sticky_terms:
+            report.append(
+                "Notes left unchanged by sticky terms: "
+                f"{self.sticky_terms.num_avoided_writes}\n"
+            )
         return "".join(report)
 
+    @property
+    def num_report_details(self) -> int:
+        return len(self.notes_to_update) + 1 if self.notes_to_update else 0
+
+    def report_details(self) -> Iterator[str]:
+        if not self.notes_to_update:
+            return
+        yield f"Hanzi Web [{self.config.web_field}]:"
+        # The details are paged through lazily, so only look up the labels of each
+        # page as it is shown.
+        for batch in batched(self.notes_to_update, REPORT_DETAILS_BATCH_SIZE):
+            labels = {
+                id: fields.split("\x1f", 1)[0]
+                for id, fields in mw.col.db.all(
+                    "select id, flds from notes where id in "
+                    + ids2str(x.id for x, _ in batch)
+                )
+            }
+            for note, _ in batch:
+                yield f"  {note.id} {labels[note.id]}"
+
     def apply(self) -> Optional[str]:
-        if not self.models_to_update and not self.notes_to_update:
-            return None
+        for _ in self.apply_in_batches():
+            pass
+        return self.tooltip
 
-        tooltip = "Hanzi Web:"
+    def apply_in_batches(self) -> Iterator[None]:
+        """Apply the changes, yielding after each batch of notes written as they are
+        rendered, so that the collection can be handed back in between.
+        """
+        if self.is_empty:
+            return
+
+        for model in self.models_to_update:
+            model.apply()
+
+        for hanzi_note, entries in self.notes_to_update:
+            self.store.stage(hanzi_note.id, self.config.web_field, entries)
 
+        if self.streamed_notes_to_update is not None:
+            log("Updating notes")
+            for batch in batched(self.streamed_notes_to_update, NOTE_WRITE_BATCH_SIZE):
+                for hanzi_note, entries in batch:
+                    self.store.stage(hanzi_note.id, self.config.web_field, entries)
+                self.num_streamed_notes += self.store.commit([x.id for x, _ in batch])
+                yield
+            self.streamed_notes_to_update = None
+
+    @property
+    def tooltip(self) -> Optional[str]:
+        """The text of the tooltip shown once the changes are applied."""
+        tooltip = "Hanzi Web:"
         if self.models_to_update:
             tooltip += f" {len(self.models_to_update)} model(s) updated."
-            for model in self.models_to_update:
-                model.apply()
-
         if self.notes_to_update:
             tooltip += f" {len(self.notes_to_update)} note(s) updated."
-            for hanzi_note, entries in self.notes_to_update:
-                note = mw.col.get_note(hanzi_note.id)
-                note[self.config.web_field] = entries
-                mw.col.update_note(note)
-
+        if self.num_streamed_notes:
+            tooltip += f" {self.num_streamed_notes} note(s) updated."
+            if self.sticky_terms and self.sticky_terms.num_avoided_writes:
+                tooltip += (
+                    f" {self.sticky_terms.num_avoided_writes} left unchanged by "
+                    "sticky terms."
+                )
+        elif not self.models_to_update and not self.notes_to_update:
+            return None
         return tooltip
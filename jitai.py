@@ -1,14 +1,62 @@
 from dataclasses import dataclass
-from re import Pattern
-from typing import Any, Optional, Sequence
+from itertools import chain
+from typing import Any, Iterable, Iterator, Optional, Sequence
 
-from anki.models import NotetypeId, NotetypeNameId
+from anki.models import NotetypeId
 from anki.notes import NoteId
+from anki.utils import ids2str
+
+from .common import (
+    Config,
+    FieldCache,
+    NoteStore,
+    NotetypePlan,
+    batched,
+    get_field_cache,
+    get_lazy_data,
+    get_notetype_plans,
+    mw,
+)
+from .kyujipy import EXCEPTIONS_KYUJITAI, KyujitaiConverter
+
+
+class CachingConverter:
+    """Shinjitai to kyūjitai converter which converts each distinct text once.
+
+    KyujitaiConverter scans its whole database with `str.replace' for every input,
+    so texts which contain no convertible character at all are passed through
+    without consulting it.
+    """
+
+    def __init__(self) -> None:
+        self._converter = KyujitaiConverter()  # type: ignore
+        self._convertible = frozenset(
+            chain(
+                *self._converter.kakikae_encode_database,
+                *self._converter.basic_converter.shinjitai_to_kyujitai_database,
+                *EXCEPTIONS_KYUJITAI,
+            )
+        )
+        self._cache: dict[str, str] = {}
+
+    def convert(self, text: str) -> str:
+        result = self._cache.get(text)
+        if result is None:
+            result = text
+            if not self._convertible.isdisjoint(text):
+                result = str(self._converter.shinjitai_to_kyujitai(text))
+            self._cache[text] = result
+        return result
+
+
+_converter: Optional[CachingConverter] = None
 
-from .common import Config, assert_is_not_none, mw, strip_kana_and_html
-from .kyujipy import KyujitaiConverter
 
-CONFIG_NORMALIZE_NOTE_TEXT = "normalize_note_text"
+def get_converter() -> CachingConverter:
+    global _converter
+    if not _converter:
+        _converter = CachingConverter()
+    return _converter
 
 
 @dataclass
@@ -17,22 +65,23 @@ class JitaiModel:
     name: str
     from_field: str
     to_field: str
+    from_ord: int
+    to_ord: int
 
 
-def create_jitai_model_from_notetype_name_id(
-    shinjitai: Pattern[Any],
-    kyujitai: str,
-    note_type: NotetypeNameId,
+def create_jitai_model(
+    config: Config, id: NotetypeId, plan: NotetypePlan
 ) -> Optional[JitaiModel]:
-    id = NotetypeId(note_type.id)
-    all_fields = mw.col.models.field_names(assert_is_not_none(mw.col.models.get(id)))
-    from_field = next(
-        (field for field in all_fields if shinjitai.fullmatch(field)), None
-    )
-    to_field = next((field for field in all_fields if kyujitai == field), None)
-    if from_field is None or to_field is None:
+    if plan.kyujitai_field_ord is None:
         return None
-    return JitaiModel(id, note_type.name, from_field, to_field)
+    return JitaiModel(
+        id,
+        plan.name,
+        plan.hanzi_fields[0],
+        config.kyujitai_field,
+        plan.hanzi_field_ords[0],
+        plan.kyujitai_field_ord,
+    )
 
 
 @dataclass
@@ -40,69 +89,75 @@ class JitaiNote:
     id: NoteId
     model: JitaiModel
     from_value: str
+    # `from_value' without HTML and furigana.
+    from_text: str
     to_value: str
 
 
-def create_jitai_note_from_id(
-    id: NoteId, models: dict[NotetypeId, JitaiModel]
-) -> Optional[JitaiNote]:
-    note = mw.col.get_note(id)
-    model = models.get(note.mid)
-    if model is None:
-        return None
-    from_value = note[model.from_field]
-    if not from_value:
-        # Skip over notes with empty sources.
-        return None
-    return JitaiNote(id, model, from_value, note[model.to_field])
+# Number of notes whose fields are read at once.
+JITAI_NOTE_BATCH_SIZE = 1000
+
+
+def create_jitai_notes(
+    field_cache: FieldCache,
+    ids: Iterable[NoteId],
+    models: dict[NotetypeId, JitaiModel],
+) -> Iterator[JitaiNote]:
+    """Read the fields of the notes from the database, without loading the notes."""
+    for batch in batched(ids, JITAI_NOTE_BATCH_SIZE):
+        rows: list[tuple[NoteId, JitaiModel, str, str]] = []
+        for id, mid, flds in mw.col.db.all(
+            f"select id, mid, flds from notes where id in {ids2str(batch)}"
+        ):
+            model = models.get(mid)
+            if model is None:
+                continue
+            fields = flds.split("\x1f")
+            from_value = fields[model.from_ord]
+            if not from_value:
+                # Skip over notes with empty sources.
+                continue
+            rows.append((NoteId(id), model, from_value, fields[model.to_ord]))
+        parsed_fields = field_cache.parse(
+            [(id, model.from_field, from_value) for id, model, from_value, _ in rows]
+        )
+        for (id, model, from_value, to_value), parsed in zip(rows, parsed_fields):
+            yield JitaiNote(id, model, from_value, parsed.stripped, to_value)
 
 
 class PendingChanges:
     config: Config
+    store: NoteStore
     models: dict[NotetypeId, JitaiModel]
     notes: list[tuple[JitaiNote, str]]
 
     def __init__(
         self,
         config: Config,
+        store: NoteStore,
         destination_note_ids: Optional[set[NoteId]],
         japanese_note_ids: set[NoteId],
     ):
         note_ids = (
             japanese_note_ids
             if destination_note_ids is None
-            else japanese_note_ids.intersection(japanese_note_ids)
+            else japanese_note_ids.intersection(destination_note_ids)
         )
 
         self.config = config
-        converter = KyujitaiConverter()  # type: ignore
-
-        def convert(x: str) -> str:
-            return str(converter.shinjitai_to_kyujitai(strip_kana_and_html(x)))  # type: ignore
-
-        self.models = (
-            {
-                model.id: model
-                for model in [
-                    create_jitai_model_from_notetype_name_id(
-                        config.hanzi_fields_regexp, config.kyujitai_field, note_type
-                    )
-                    for note_type in mw.col.models.all_names_and_ids()
-                ]
-                if model
-            }
-            if config.hanzi_fields_regexp
-            else {}
-        )
-        notes = [
-            note
-            for note in [create_jitai_note_from_id(id, self.models) for id in note_ids]
-            if note
-        ]
+        self.store = store
+        converter = get_converter()
+        field_cache = get_field_cache()
+
+        self.models = {
+            id: model
+            for id, plan in get_notetype_plans(config, get_lazy_data().js).items()
+            if (model := create_jitai_model(config, id, plan))
+        }
         self.notes = [
             (note, conversion)
-            for note in notes
-            if (conversion := convert(note.from_value)) != note.to_value
+            for note in create_jitai_notes(field_cache, note_ids, self.models)
+            if (conversion := converter.convert(note.from_text)) != note.to_value
         ]
 
     @property
@@ -125,9 +180,7 @@ class PendingChanges:
                 )
 
             if self.notes:
-                report.append(f"\nNotes to update ({len(self.notes)}):\n")
-                for note, to_value in self.notes:
-                    report.append(f"  {note.id} {note.from_value} -> {to_value}\n")
+                report.append(f"\nNotes to update: {len(self.notes)}\n")
             else:
                 report.append("\nNo notes to update.\n")
         else:
@@ -137,22 +190,23 @@ class PendingChanges:
 
         return "".join(report)
 
+    @property
+    def num_report_details(self) -> int:
+        return len(self.notes) + 1 if self.notes else 0
+
+    def report_details(self) -> Iterator[str]:
+        if not self.notes:
+            return
+        yield "Kyūjitai:"
+        for note, to_value in self.notes:
+            yield f"  {note.id} {note.from_value} -> {to_value}"
+
     def apply(self) -> Optional[str]:
         if not self.notes:
             return None
 
-        # Prevent Anki from un-kyujitai-ing these character forms.
-        normalize_note_text = mw.col.conf.get(CONFIG_NORMALIZE_NOTE_TEXT)
-        try:
-            mw.col.conf[CONFIG_NORMALIZE_NOTE_TEXT] = False
-
-            for jitai_note, to_value in self.notes:
-                note = mw.col.get_note(jitai_note.id)
-                note[jitai_note.model.to_field] = to_value
-                mw.col.update_note(note)
-            return f"Kyūjitai: {len(self.notes)} notes updated."
-        finally:
-            if normalize_note_text is None:
-                del mw.col.conf[CONFIG_NORMALIZE_NOTE_TEXT]
-            else:
-                mw.col.conf[CONFIG_NORMALIZE_NOTE_TEXT] = normalize_note_text
+        for jitai_note, to_value in self.notes:
+            self.store.stage(
+                jitai_note.id, jitai_note.model.to_field, to_value, preserve_text=True
+            )
+        return f"Kyūjitai: {len(self.notes)} notes updated."
@@ -0,0 +1,204 @@
+# This script regenerates the data files shipped with Hanzi Web.
+#
+# Each output is only regenerated if the contents of its inputs (including the
+# scripts which generate it) changed since it was last built. The digests of the
+# inputs and outputs of every step are kept in .build-cache.json.
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable
+
+ROOT = Path(__file__).resolve().parent.parent
+TOOLS = ROOT / "tools"
+CACHE_PATH = ROOT / ".build-cache.json"
+
+
+@dataclass(frozen=True)
+class Step:
+    output: str
+    script: str
+    # Inputs passed to the script as arguments.
+    arguments: list[str]
+    # Other files the output depends on.
+    dependencies: list[str]
+    validate: Callable[[Any], None]
+
+
+def check(condition: Any, message: Any) -> None:
+    # Raised rather than asserted, so that `python -O' still validates.
+    if not condition:
+        raise ValueError(message)
+
+
+def validate_kanjidic_onyomi(data: Any) -> None:
+    check(isinstance(data, dict) and data, "expected non-empty object")
+    for kanji, readings in data.items():
+        check(len(kanji) == 1, f"bad kanji {kanji!r}")
+        check(readings and all(isinstance(x, str) for x in readings), kanji)
+
+
+def validate_kanji_onyomi(data: Any) -> None:
+    check(isinstance(data, dict) and data, "expected non-empty object")
+    for kanji, all_readings in data.items():
+        check(len(kanji) == 1, f"bad kanji {kanji!r}")
+        check(all_readings, kanji)
+        for readings in all_readings:
+            # A kind followed by at least one reading.
+            check(len(readings) >= 2, kanji)
+            check(all(isinstance(x, str) and x for x in readings), kanji)
+
+
+def validate_phonetics(data: Any) -> None:
+    check(isinstance(data, dict), "expected object")
+    check(
+        set(data) == {"components", "japanese_components", "series", "japanese_series"},
+        data.keys(),
+    )
+    for index in data.values():
+        check(isinstance(index, dict) and index, "expected non-empty object")
+        for hanzi, value in index.items():
+            check(len(hanzi) == 1, f"bad hanzi {hanzi!r}")
+            check(isinstance(value, str) and value, hanzi)
+    for components_key, series_key in (
+        ("components", "series"),
+        ("japanese_components", "japanese_series"),
+    ):
+        for hanzi, components in data[components_key].items():
+            for component in components:
+                check(hanzi in data[series_key][component], (hanzi, component))
+
+
+def make_steps(kanjidic: str, kanji_bank: str) -> list[Step]:
+    return [
+        Step(
+            "kanjidic-onyomi.json",
+            "make-kanjidic-onyomi.py",
+            [kanjidic],
+            ["tools/kanjidic.py"],
+            validate_kanjidic_onyomi,
+        ),
+        Step(
+            "kanji-onyomi.json",
+            "make-kanji-onyomi.py",
+            [kanji_bank, "kanjidic-onyomi.json"],
+            [],
+            validate_kanji_onyomi,
+        ),
+        Step(
+            "phonetics.json",
+            "make-phonetics.py",
+            [],
+            ["kyujipy/kyujitai.json"],
+            validate_phonetics,
+        ),
+    ]
+
+
+def digest_file(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as fp:
+        while chunk := fp.read(1 << 20):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def digest_inputs(step: Step) -> dict[str, str]:
+    paths = [f"tools/{step.script}", *step.arguments, *step.dependencies]
+    return {path: digest_file(ROOT / path) for path in paths}
+
+
+def run_step(step: Step) -> None:
+    output_path = ROOT / step.output
+    temp_path = output_path.with_suffix(".tmp")
+    try:
+        with open(temp_path, "wb") as fp:
+            subprocess.run(
+                [sys.executable, str(TOOLS / step.script), *step.arguments],
+                cwd=ROOT,
+                stdout=fp,
+                check=True,
+            )
+        with open(temp_path, encoding="utf-8") as fp:
+            step.validate(json.load(fp))
+        os.replace(temp_path, output_path)
+    finally:
+        temp_path.unlink(missing_ok=True)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description="Regenerate the data files shipped with Hanzi Web."
+    )
+    parser.add_argument("--kanjidic", default="kanjidic2.xml")
+    parser.add_argument("--kanji-bank", default="kanji_bank_1.json")
+    parser.add_argument("--force", action="store_true", help="rebuild everything")
+    parser.add_argument("outputs", nargs="*", help="outputs to build (default: all)")
+    args = parser.parse_args()
+
+    steps = make_steps(args.kanjidic, args.kanji_bank)
+    known_outputs = {step.output for step in steps}
+    for output in args.outputs:
+        if output not in known_outputs:
+            parser.error(f"unknown output: {output}")
+
+    try:
+        with open(CACHE_PATH, encoding="utf-8") as fp:
+            cache = json.load(fp)
+    except (OSError, ValueError):
+        cache = {}
+
+    # Also build whatever the requested outputs are generated from.
+    wanted = set(args.outputs or known_outputs)
+    for step in reversed(steps):
+        if step.output in wanted:
+            wanted.update(x for x in step.arguments if x in known_outputs)
+
+    # Steps are listed in dependency order, so earlier outputs are always up to date
+    # by the time they are digested as inputs of later steps.
+    total_start = time.perf_counter()
+    for step in steps:
+        if step.output not in wanted:
+            continue
+        start = time.perf_counter()
+        output_path = ROOT / step.output
+        try:
+            inputs = digest_inputs(step)
+            entry = cache.get(step.output)
+            is_up_to_date = (
+                not args.force
+                and entry
+                and entry["inputs"] == inputs
+                and output_path.exists()
+                and entry["output"] == digest_file(output_path)
+            )
+            if not is_up_to_date:
+                run_step(step)
+        except (OSError, subprocess.CalledProcessError, ValueError) as e:
+            print(f"{step.output}: failed: {e}", file=sys.stderr)
+            return 1
+        if is_up_to_date:
+            status = "up to date"
+        else:
+            cache[step.output] = {
+                "inputs": inputs,
+                "output": digest_file(output_path),
+            }
+            with open(CACHE_PATH, "w", encoding="utf-8") as fp:
+                json.dump(cache, fp, indent=2, sort_keys=True)
+            status = "built"
+        print(
+            f"{step.output}: {status} in {time.perf_counter() - start:.2f}s",
+            file=sys.stderr,
+        )
+    print(f"total: {time.perf_counter() - total_start:.2f}s", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
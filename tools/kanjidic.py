@@ -0,0 +1,36 @@
+from dataclasses import dataclass
+from typing import Iterator
+from xml.etree.ElementTree import iterparse
+
+
+@dataclass(frozen=True)
+class Character:
+    literal: str
+    onyomi: list[str]
+    meanings: list[str]
+
+
+def iter_characters(path: str) -> Iterator[Character]:
+    """Stream each character entry of a KANJIDIC2 XML file.
+
+    Entries are discarded as soon as they are parsed, so memory use does not depend
+    on the size of the file.
+    """
+    events = iterparse(path, events=("start", "end"))
+    _, root = next(events)
+    for event, element in events:
+        if event != "end" or element.tag != "character":
+            continue
+        onyomi = [
+            reading.text or ""
+            for reading in element.iterfind("reading_meaning/rmgroup/reading")
+            if reading.get("r_type") == "ja_on"
+        ]
+        meanings = [
+            meaning.text or ""
+            for meaning in element.iterfind("reading_meaning/rmgroup/meaning")
+            # English meanings have no language attribute.
+            if meaning.get("m_lang") is None
+        ]
+        yield Character(element.findtext("literal") or "", onyomi, meanings)
+        root.clear()
@@ -0,0 +1,20 @@
+# This script displays a list of all kokuji in KANJIDIC that contain an
+# on-reading, excluding kanji that are known to not have a phonetic component.
+import sys
+
+from kanjidic import iter_characters
+
+# Kokuji known to not have a phonetic component.
+EXCLUDED = set("雫腺鱈弖扨鮠桛")
+
+if len(sys.argv) != 2:
+    print("usage: list-kokuji-with-on-readings.py KANJIDIC-XML-FILE", file=sys.stderr)
+    sys.exit(1)
+
+for character in iter_characters(sys.argv[1]):
+    if (
+        character.onyomi
+        and any(meaning in ("kokuji", "(kokuji)") for meaning in character.meanings)
+        and character.literal not in EXCLUDED
+    ):
+        print(character.literal)
@@ -3,6 +3,21 @@ import json
 import re
 import sys
 
+# Separates the kinds of readings from the readings themselves.
+KINDS_SEPARATOR_REGEXP = re.compile(r"\s*[：:]\s*")
+
+# Separates individual kinds of readings.
+KIND_SEPARATOR_REGEXP = re.compile(r"\s*[,、・\s]\s*")
+
+# Separates individual readings.
+READING_SEPARATOR_REGEXP = re.compile(r"\s*[,、\s]\s*")
+
+# Matches readings, which start with katakana.
+READING_REGEXP = re.compile(r"^[ァ-ヾ]")
+
+# Converts parentheses to their full-width forms.
+PARENTHESES_TABLE = str.maketrans("()", "（）")
+
 
 def gather_readings(kanji: str, definition: list[str]) -> dict[str, list[str]]:
     # HACK: Entry for 灯 is uniquely formatted.
@@ -20,12 +35,12 @@ def gather_readings(kanji: str, definition: list[str]) -> dict[str, list[str]]:
     except StopIteration:
         return {}
 
-    result: dict[str, list[str]] = {}
+    result: dict[str, dict[str, None]] = {}
     for it in definition[onyomi_index:]:
         if it.startswith("ー") or it.startswith("＝") or "訓読" in it or it == "無し":
             break
 
-        split = re.split(r"\s*[：:]\s*", it, maxsplit=2)
+        split = KINDS_SEPARATOR_REGEXP.split(it, maxsplit=2)
         if len(split) == 1:
             # unspecified
             kinds_str = "音読み"
@@ -37,7 +52,7 @@ def gather_readings(kanji: str, definition: list[str]) -> dict[str, list[str]]:
             continue
 
         # Separate and clean up kinds.
-        kinds = re.split(r"\s*[,、・\s]\s*", kinds_str)
+        kinds = KIND_SEPARATOR_REGEXP.split(kinds_str)
         if kanji == "谷":
             kinds = ["慣用音" if kind == "特殊な慣用音" else kind for kind in kinds]
         if not kinds:
@@ -46,22 +61,18 @@ def gather_readings(kanji: str, definition: list[str]) -> dict[str, list[str]]:
         # Separate and clean up readings.
         if not readings_str:
             continue
-        readings = re.split(r"\s*[,、\s]\s*", readings_str)
-        readings = [reading for reading in readings if re.match(r"^[ァ-ヾ]", reading)]
-        readings = [reading.replace("(", "（") for reading in readings]
-        readings = [reading.replace(")", "）") for reading in readings]
+        readings = [
+            reading.translate(PARENTHESES_TABLE)
+            for reading in READING_SEPARATOR_REGEXP.split(readings_str)
+            if READING_REGEXP.match(reading)
+        ]
         if not readings:
             continue
 
         for kind in kinds:
-            if kind in result:
-                extant = result[kind]
-                for reading in readings:
-                    if reading not in extant:
-                        extant.append(reading)
-            else:
-                result[kind] = list(readings)
-    return result
+            # Dicts preserve insertion order, so they double as ordered sets.
+            result.setdefault(kind, {}).update(dict.fromkeys(readings))
+    return {kind: list(readings) for kind, readings in result.items()}
 
 
 # Roughly sorted by age, excepting 慣用音.
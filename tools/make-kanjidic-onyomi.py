@@ -0,0 +1,20 @@
+# This script generates a JSON object which maps kanji to their onyomi.
+import json
+import sys
+
+from kanjidic import iter_characters
+
+if len(sys.argv) != 2:
+    print("usage: make-kanjidic-onyomi.py KANJIDIC-XML-FILE", file=sys.stderr)
+    sys.exit(1)
+
+json.dump(
+    {
+        character.literal: character.onyomi
+        for character in iter_characters(sys.argv[1])
+        if character.onyomi
+    },
+    sys.stdout,
+    ensure_ascii=False,
+    separators=(",", ":"),
+)
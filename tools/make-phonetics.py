@@ -1,7 +1,12 @@
 from itertools import chain
+from pathlib import Path
+from typing import Iterable
 import json
 import sys
 
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from kyujipy import BasicConverter
+
 # Data retrieved from Wiktionary 2022-10-18.
 #
 # https://en.wiktionary.org/wiki/Module:zh-glyph/phonetic
@@ -1096,17 +1101,53 @@ def generate_components_by_phonetic_series() -> dict[str, str]:
         KOKUJI_PHONETIC_SERIES_BY_COMPONENT.items(),
     ):
         for hanzi in all_hanzi:
-            s = result.get(hanzi)
-            if s:
-                if phonetic_series_hanzi not in s:
-                    s += phonetic_series_hanzi
-            else:
-                result[hanzi] = phonetic_series_hanzi
+            s = result.get(hanzi, "")
+            if phonetic_series_hanzi not in s:
+                result[hanzi] = s + phonetic_series_hanzi
+    return result
+
+
+def generate_phonetic_series_by_component(
+    components_by_hanzi: dict[str, str], hanzi: Iterable[str]
+) -> dict[str, str]:
+    result: dict[str, str] = {}
+    for h in hanzi:
+        for component in components_by_hanzi.get(h, ""):
+            result[component] = result.get(component, "") + h
     return result
 
 
+def generate_phonetics() -> dict[str, dict[str, str]]:
+    components_by_hanzi = generate_components_by_phonetic_series()
+
+    # Japanese notes look up the phonetic series of the kyūjitai form of each of their
+    # hanzi, so also index every form which converts to a member of a series.
+    converter = BasicConverter()  # type: ignore
+    japanese_hanzi = sorted(
+        set(components_by_hanzi).union(
+            x for x in converter.shinjitai_to_kyujitai_database if len(x) == 1
+        )
+    )
+    components_by_japanese_hanzi = {
+        h: components
+        for h in japanese_hanzi
+        if (components := components_by_hanzi.get(converter.shinjitai_to_kyujitai(h)))
+    }
+
+    return {
+        "components": components_by_hanzi,
+        "japanese_components": components_by_japanese_hanzi,
+        "series": generate_phonetic_series_by_component(
+            components_by_hanzi, components_by_hanzi
+        ),
+        "japanese_series": generate_phonetic_series_by_component(
+            components_by_japanese_hanzi, japanese_hanzi
+        ),
+    }
+
+
 json.dump(
-    generate_components_by_phonetic_series(),
+    generate_phonetics(),
     sys.stdout,
     ensure_ascii=False,
     separators=(",", ":"),